@@ -1,13 +1,32 @@
+import functools
 import os
+import threading
+import time
 import requests
 import uuid
-import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
+import cache
+import client
+import journal
+import jsonstream
+import metrics
+import ratelimit
+import resample
+import schema
+import state
+import token_registry
 import utils
+import writer
 from settings import *
 
 
+# Transactions to commit at the end of each subject, by pseudonym
+_deferred = {}
+_deferred_lock = threading.Lock()
+
+
 def register(token):
     ''' Register a new user
 
@@ -15,15 +34,9 @@ def register(token):
     id : (Optional) Desired ID of the user
     '''
 
-    headers = {
-        'Content-Type': 'application/json',
-        'Accept': 'application/json',
-        'Authorization': f'Bearer {token}',
-        'Connection': 'keep-alive'
-    }
     json = {"member-id": uuid.uuid4().hex}
 
-    r = requests.post(api_url, json=json, headers = headers)
+    r = client.post(token, api_url, json=json)
 
     if r.status_code == 409:
         print("User already registered")
@@ -39,14 +52,8 @@ def activities_transaction(token, user_id):
     return : True if there is new data
     '''
 
-    headers = {
-        'Accept': 'application/json',
-        'Authorization': f'Bearer {token}',
-        'Connection': 'keep-alive'
-    }
-
     url = api_url+f'/{user_id}/activity-transactions'
-    r = requests.post(url, headers = headers)
+    r = client.post(token, url)
 
     if r.status_code == 204:
         # print("No activity data")
@@ -69,14 +76,8 @@ def exercise_transaction(token, user_id):
              otherwise None
     '''
 
-    headers = {
-        'Accept': 'application/json',
-        'Authorization': f'Bearer {token}',
-        'Connection': 'keep-alive'
-    }
-
     url = api_url + f'/{user_id}/exercise-transactions'
-    r = requests.post(url, headers = headers)
+    r = client.post(token, url)
 
     if r.status_code == 204:
         #print("No exercise data")
@@ -100,14 +101,8 @@ def activity_list(token, user_id, transaction):
     return : list of urls for fetching activity data
     '''
 
-    headers = {
-        'Accept': 'application/json',
-        'Authorization': f'Bearer {token}',
-        'Connection': 'keep-alive'
-    }
-
     url = api_url + f'/{user_id}/activity-transactions/{transaction}'
-    r = requests.get(url, headers=headers)
+    r = client.get(token, url)
     r.raise_for_status()
 
     if r.status_code == 204:
@@ -129,14 +124,8 @@ def exercise_list(token, user_id, transaction):
     '''
     print("getting list of exercises")
 
-    headers = {
-        'Accept': 'application/json',
-        'Authorization': f'Bearer {token}',
-        'Connection': 'keep-alive'
-    }
-
     url = api_url + f'/{user_id}/exercise-transactions/{transaction}'
-    r = requests.get(url, headers=headers)
+    r = client.get(token, url)
     r.raise_for_status()
 
     if r.status_code == 204:
@@ -153,24 +142,18 @@ def sleep_list(token):
 
     token : The oauth2 authorization token of the user
 
-    return : List of sleep summaries
+    return : Iterator of sleep summaries, decoded one night at a time
     '''
 
-    headers = {
-        'Accept': 'application/json',
-        'Authorization': f'Bearer {token}',
-        'Connection': 'keep-alive'
-    }
-
     url = api_url + '/sleep'
-    r = requests.get(url, headers=headers)
+    r = client.get(token, url, stream=True)
     r.raise_for_status()
 
     if r.status_code == 204:
-        return []
+        r.close()
+        return iter([])
 
-    r = r.json()
-    return r['nights']
+    return jsonstream.items(r, ['nights'])
 
 
 def recharge_list(token):
@@ -179,24 +162,18 @@ def recharge_list(token):
 
     token : The oauth2 authorization token of the user
 
-    return : List of sleep recharge summaries
+    return : Iterator of sleep recharge summaries, decoded one at a time
     '''
 
-    headers = {
-        'Accept': 'application/json',
-        'Authorization': f'Bearer {token}',
-        'Connection': 'keep-alive'
-    }
-
     url = api_url + '/nightly-recharge'
-    r = requests.get(url, headers=headers)
+    r = client.get(token, url, stream=True)
     r.raise_for_status()
 
     if r.status_code == 204:
-        return []
-    r = r.json()
+        r.close()
+        return iter([])
 
-    return r['recharges']
+    return jsonstream.items(r, ['recharges'])
 
 
 def activity_summary(token, user_id, url):
@@ -209,17 +186,11 @@ def activity_summary(token, user_id, url):
     return : summary dictionary
     '''
 
-    headers = {
-        'Accept': 'application/json',
-        'Authorization': f'Bearer {token}',
-        'Connection': 'keep-alive'
-    }
-
-    r = requests.get(url, headers=headers)
-    r.raise_for_status()
-
-    summary = r.json()
-    return summary
+    # The summary of a day changes during the day, so it is not cached
+    body = cache.download(token, url)
+    if body is None:
+        return None
+    return jsonstream.load(body)
 
 
 def pull_exercise_samples(token, user_id, subject_id, url, exercise_start_time):
@@ -232,44 +203,52 @@ def pull_exercise_samples(token, user_id, subject_id, url, exercise_start_time):
     exercise_start_time : The start time of the exercise (unique identifier)
     '''
 
-    # Initialize an empty dataframe with appropriate columns for the new data
     filename = raw_data_folder+"exercise_samples.csv"
-    columns = ['subject_id', 'exercise-start-time', 'sample-index', 'recording-rate', 'sample-type', 'sample-name', 'sample']
-    sampledata = pd.DataFrame(columns=columns)
-
-    # fetch the samples
-    headers = {
-        'Accept': 'application/json',
-        'Authorization': f'Bearer {token}',
-        'Connection': 'keep-alive'
-    }
 
-    r = requests.get(url+'/samples', headers=headers)
-    r.raise_for_status()
+    sample_list = cache.open_url(token, url+'/samples')
 
     # Return None if this exercise does not exist or has no data
-    if r.status_code == 204:
+    if sample_list is None:
         return None
 
-    # Flatten and format the data.
-    for sample_url in r.json()['samples']:
-        sample = requests.get(sample_url, headers=headers)
-
-        sample = sample.json()
-        sample_list = sample['data'].split(',')
-        samples = [{
-                       'subject_id': subject_id,
-                       'exercise-start-time': exercise_start_time,
-                       'sample-index': i,
-                       'recording-rate': sample['recording-rate'],
-                       'sample-type': sample['sample-type'],
-                       'sample-name': sample_names[sample['sample-type']],
-                       'sample': sample_line
-                   } for i, sample_line in enumerate(sample_list)]
-        sampledata = sampledata.append(samples, ignore_index=True)
-
-    # write to file
-    sampledata.to_csv(filename, mode='a', header=False)
+    # Fetch all sample types at once. Each sample type is decoded as it
+    # is read and written on its own, so only the sample types currently
+    # being fetched are held in memory.
+    import numpy as np
+    import pandas as pd
+
+    def pull_sample(sample_url):
+        sample = cache.open_url(token, sample_url)
+        if sample is None:
+            return
+        sample = jsonstream.load(sample)
+
+        # Parse the sample string straight into numbers. Blank or malformed
+        # values are missing.
+        fields = sample['data'].split(',')
+        try:
+            values = np.array(fields, dtype='float64')
+        except ValueError:
+            values = pd.to_numeric(pd.Series(fields), errors='coerce').to_numpy(
+                dtype='float64', na_value=np.nan)
+
+        # Format the data. Each column is built at once, typed so that it is
+        # not converted again, and the per-sample values are repeated for
+        # every point.
+        sampledata = schema.of('exercise_samples').frame({
+            'subject_id': subject_id,
+            'exercise-start-time': exercise_start_time,
+            'sample-index': pd.Series(np.arange(len(values)), dtype='Int64'),
+            'recording-rate': sample['recording-rate'],
+            'sample-type': sample['sample-type'],
+            'sample-name': sample_names[int(sample['sample-type'])],
+            'sample': pd.Series(values, dtype='Float64')
+        })
+
+        # write to file, resampled if set in settings.resample_mode
+        resample.write(filename, exercise_sample_columns, sampledata)
+
+    utils.map_concurrent(pull_sample, list(jsonstream.items(sample_list, ['samples'])))
 
 
 def exercise_summary(token, user_id, url):
@@ -282,46 +261,36 @@ def exercise_summary(token, user_id, url):
     return : summary dictionary
     '''
 
-    headers = {
-        'Accept': 'application/json',
-        'Authorization': f'Bearer {token}',
-        'Connection': 'keep-alive'
-    }
-
-    r = requests.get(url, headers=headers)
+    return fetch_data(token, url)
 
-    r.raise_for_status()  # Raises common error codes
 
-    summary = r.json()
-    return summary
-
-
-def fetch_data(token, url):
-    ''' Fetch data from a given url using token authentication '''
-    # Standard headers for Acceslink
-    headers = {
-        'Accept': 'application/json',
-        'Authorization': f'Bearer {token}',
-        'Connection': 'keep-alive'
-    }
+def fetch_data(token, url, items=None, version=None):
+    ''' Fetch data from a given url using token authentication. The
+    response is cached until the transaction of the url is committed, so
+    use this only for data that does not change.
 
-    # Fetch data if available
-    r = requests.get(url, headers=headers)
-
-    # Raise common errors
-    r.raise_for_status()
+    items : (Optional) key of an array in the response. If given, an
+            iterator over the items of the array is returned instead,
+            decoded while the response is read.
+    version : (Optional) version of the data, part of its cache key
+    '''
+    # Fetch data if available. Raises common errors.
+    body = cache.open_url(token, url, version)
 
     # Return None if the server returns '204: no data'.
     # This might indicate that the data is already fetched, or that none
     # ever existed.
-    if r.status_code == 204:
+    if body is None:
         return None
 
+    if items is not None:
+        return jsonstream.items(body, [items])
+
     # Convert to json and return
-    return r.json()
+    return jsonstream.load(body)
 
 
-def pull_steps(token, user_id, subject_id, url, date):
+def pull_steps(token, user_id, subject_id, url, date, created=None):
     ''' Fetch step data from a given activity and write
     them to the step log. If step data for the day already
     exists, overwrite.
@@ -330,40 +299,32 @@ def pull_steps(token, user_id, subject_id, url, date):
     user_id : The polar user ID of the user
     url : url for the activity (provided by activity_list)
     date : the date of the activity data
+    created : (Optional) the created stamp of the activity summary
     '''
 
     # Fetch the data
-    r = fetch_data(token, url+'/step-samples')
-    if r is None:
+    samples = fetch_data(token, url+'/step-samples', items='samples', version=created)
+    if samples is None:
         print("No step data, is transaction open?")
         return
 
-    # Add date and subject ID to all the samples
-    samples = r['samples']
+    # Add date and subject ID to all the samples. Remove any that do not
+    # have the steps-column. These presumably have 0 steps.
+    rows = schema.of('activity_steps').buffer()
+    for s in samples:
+        if 'steps' in s:
+            rows.add(s, subject_id=subject_id, date=date)
 
-    if len(samples) == 0:
+    if len(rows) == 0:
         print("Length of samples is 0 in pull_steps")
         return
 
-    for s in samples:
-        s['date'] = date
-        s['subject_id'] = subject_id
-
-    # Remove any that do not have the steps-column. These presumably have 0
-    # steps.
-    samples = [s for s in samples if 'steps' in s]
-
-    # Read from the file or initialize an empty dataframe
-    filename = raw_data_folder+"activity_steps.csv"
-    columns = ["subject_id", "date", "time", "steps"]
-
     # Save the new data
-    stepdata = pd.DataFrame(columns=columns)
-    stepdata = stepdata.append(samples)
-    stepdata.to_csv(filename, mode='a', header=False)
+    filename = raw_data_folder+"activity_steps.csv"
+    writer.write(filename, step_columns, rows)
 
 
-def pull_zones(token, user_id, subject_id, url, date):
+def pull_zones(token, user_id, subject_id, url, date, created=None):
     ''' Fetch heart rate zone data from a given activity and
     write them to the heart rate zone log. If heart rate zone
     data for the day already exists, overwrite.
@@ -372,68 +333,57 @@ def pull_zones(token, user_id, subject_id, url, date):
     user_id : The polar user ID of the user
     url : url for the activity (provided by activity_list)
     date : the date of the activity data
+    created : (Optional) the created stamp of the activity summary
     '''
 
     # Fetch the data
-    r = fetch_data(token, url+'/zone-samples')
-    if r is None:
+    zone_samples = fetch_data(token, url+'/zone-samples', items='samples',
+                              version=created)
+    if zone_samples is None:
         print("No zone data, is transaction open?")
         return
 
-    # Flatten the zone data hierarchy
-    samples = []
-    for rs in r['samples']:
+    # Flatten the zone data hierarchy. The "index" column is left empty.
+    samples = schema.of('activity_zones').buffer()
+    for rs in zone_samples:
         if 'activity-zones' in rs:
             for zone in rs['activity-zones']:
-                duration = utils.extract_time(zone['inzone'])
-
-                s = {'subject_id': subject_id,
-                     'date': date,
-                     'time': rs['time'],
-                     'zone index': zone['index'],
-                     'zone name': zone_names[zone['index']],
-                     'duration': duration}
-                samples.append(s)
+                samples.append((subject_id, date, rs['time'], None, zone['inzone'],
+                                zone['index'], zone_names[zone['index']]))
 
     if len(samples) == 0:
         print("Length of samples is 0 in pull_zones")
         return
 
-    # Read from the file or initialize an empty dataframe
-    filename = raw_data_folder+"activity_zones.csv"
-    columns = ["subject_id", "date", "time", "index", "duration"]
+    # Convert the durations to seconds all at once
+    samples.columns['duration'] = utils.extract_times(samples.column('duration'))
 
-    # Append the new data and write
-    zonedata = pd.DataFrame(columns=columns)
-    zonedata = zonedata.append(samples, ignore_index=True)
-    zonedata.to_csv(filename, mode='a', header=False)
+    # Append the new data
+    filename = raw_data_folder+"activity_zones.csv"
+    writer.write(filename, zone_columns, samples)
 
 
 def commit_activity(token, user_id, transaction):
     ''' Commit an activity transaction '''
 
-    headers = {
-        'Authorization': f'Bearer {token}',
-        'Connection': 'keep-alive'
-    }
-
     url = api_url+f'/{user_id}/activity-transactions/{transaction}'
-    r = requests.put(url, headers=headers)
+    r = client.put(token, url)
     r.raise_for_status()
 
+    # The cached responses of the transaction are no longer needed
+    cache.invalidate(user_id, 'activity')
+
 
 def commit_exercise(token, user_id, transaction):
     ''' Commit an exercise transaction '''
 
-    headers = {
-        'Authorization': f'Bearer {token}',
-        'Connection': 'keep-alive'
-    }
-
     url = api_url+f'/{user_id}/exercise-transactions/{transaction}'
-    r = requests.put(url, headers=headers)
+    r = client.put(token, url)
     r.raise_for_status()
 
+    # The cached responses of the transaction are no longer needed
+    cache.invalidate(user_id, 'exercise')
+
 
 def time_to_sec(time_string):
     ''' Utility for mapping a time string to an integer
@@ -474,11 +424,14 @@ def pull_activities(token, user_id, subject_id):
     # so the last one contains the latest data.
     # So first check all summaries and keep the last one
     # for each date
+    # The summaries are fetched concurrently, but handled in the order of
+    # url_list, so the selection is the same as fetching them one by one.
     summary_list = {}
-    for url in url_list:
-        # Get the summary and specifically note the date.
+    fetched = utils.map_concurrent(
+        lambda url: activity_summary(token, user_id, url), url_list)
+    for url, summary in zip(url_list, fetched):
+        # Note the date of the summary.
         # There is only one final entry for each date.
-        summary = activity_summary(token, user_id, url)
         date = summary['date']
         this_time = time_to_sec(summary['created'])
         summary_info = {
@@ -496,30 +449,36 @@ def pull_activities(token, user_id, subject_id):
                 summary_list[date] = summary_info
 
     # Now check for new
-    summaries = pd.DataFrame(columns=activity_columns)
+    summaries = schema.of('activity_summary').buffer()
     for summary_info in summary_list.values():
-        # Prune the summary data
+        # Add the given set of columns of the summary
         summary = summary_info['summary']
-        pruned_data = utils.prune_data(summary, activity_columns)
-        pruned_data['duration'] = utils.extract_time(pruned_data['duration'])
-        pruned_data['subject_id'] = subject_id
-
-        # Add the summary
-        summaries = summaries.append(pruned_data, ignore_index=True)
-
-        # Get step and zone data for the summary
-        try:
-          pull_steps(token, user_id, subject_id, summary_info['url'], summary['date'])
-          pull_zones(token, user_id, subject_id, summary_info['url'], summary['date'])
-        except Exception as e:
-          print("Encountered error:", e)
-          # return without committing. The data should be available tomorrow.
-          return False
+        summaries.add(summary, subject_id=subject_id)
+    summaries.columns['duration'] = utils.extract_times(summaries.column('duration'))
 
+    # Get step and zone data for each summary, all dates at once
+    def pull_samples(task):
+        pull_function, summary_info = task
+        summary = summary_info['summary']
+        pull_function(token, user_id, subject_id, summary_info['url'], summary['date'],
+                      summary.get('created'))
 
-    # Commit the transaction and write the data
-    commit_activity(token, user_id, transaction)
-    summaries.to_csv(filename, mode='a', header=False)
+    tasks = [(pull_function, summary_info)
+             for summary_info in summary_list.values()
+             for pull_function in (pull_steps, pull_zones)]
+    try:
+      utils.map_concurrent(pull_samples, tasks)
+    except Exception as e:
+      print("Encountered error:", e)
+      # return without committing. The data should be available tomorrow.
+      return False
+
+    # Write the data. The transaction is committed at the end of the
+    # subject, once all of its rows are on disk. If the run stops before
+    # that, the data is fetched again in the next run.
+    writer.write(filename, activity_columns, summaries)
+    defer_commit(subject_id, 'activities',
+                 lambda: commit_activity(token, user_id, transaction))
 
     return True
 
@@ -542,7 +501,7 @@ def pull_exercises(token, user_id, subject_id):
         return
 
     # Now check for new
-    summaries = pd.DataFrame(columns=exercise_columns)
+    summaries = schema.of('exercise_summary').buffer()
     for url in exercise_list(token, user_id, transaction):
         # Get the summary and specifically note the start-time.
         # There is only one final entry for each start-time.
@@ -557,20 +516,20 @@ def pull_exercises(token, user_id, subject_id):
           pass
         summary['subject_id'] = subject_id
 
-        # Add to the dataframe
-        pruned_data = utils.prune_data(summary, exercise_columns)
-        pruned_data['duration'] = utils.extract_time(pruned_data['duration'])
-        summaries = summaries.append(pruned_data, ignore_index=True)
+        # Add the given set of columns
+        summaries.add(summary)
 
         print("pulling sample")
 
-        pull_exercise_samples(token, user_id, subject_id, url, pruned_data['start-time'])
+        pull_exercise_samples(token, user_id, subject_id, url, summary.get('start-time'))
 
-    # Commit the transaction
-    commit_exercise(token, user_id, transaction)
+    summaries.columns['duration'] = utils.extract_times(summaries.column('duration'))
 
-    # Write to the file
-    summaries.to_csv(filename, mode='a', header=False)
+    # Write to the file and commit the transaction at the end of the
+    # subject, once the rows are on disk
+    writer.write(filename, exercise_columns, summaries)
+    defer_commit(subject_id, 'exercises',
+                 lambda: commit_exercise(token, user_id, transaction))
 
 
 def pull_sleep_summary_date(token, subject_id, year, month, day):
@@ -578,60 +537,50 @@ def pull_sleep_summary_date(token, subject_id, year, month, day):
     token : The oauth2 authorization token of the user
     subject_id : The polar subject ID of the user
     date : The date of the sleep summary formatted as "YYYY-MM-DD"
-    '''
 
-    headers = {
-        'Accept': 'application/json',
-        'Authorization': f'Bearer {token}',
-        'Connection': 'keep-alive'
-    }
+    returns : the summary as a record of the sleep_summary schema, None if
+              there is no summary for the date
+    '''
 
     url = f'{api_url}/sleep/{year:04}-{month:02}-{day:02}'
-    r = requests.get(url, headers=headers)
+    r = client.get(token, url)
     r.raise_for_status()
 
     if r.status_code == 204:
-        return []
+        return None
 
     summary = r.json()
 
     if 'heart_rate_samples' in summary:
-        retry_and_report(handle_sleep_sample, subject_id, summary['date'], summary['heart_rate_samples'], "heart rate")
+        handle_sleep_sample(subject_id, summary['date'], summary['heart_rate_samples'], "heart rate")
     if 'hypnogram' in summary:
-        retry_and_report(handle_sleep_sample, subject_id, summary['date'], summary['hypnogram'], "hypnogram")
+        handle_sleep_sample(subject_id, summary['date'], summary['hypnogram'], "hypnogram")
 
     # Take only the given set of columns
-    pruned_data = prune_data(summary, sleep_columns)
-    pruned_data['subject_id'] = subject_id
-    return pruned_data
+    return schema.of('sleep_summary').record(summary, subject_id=subject_id)
 
 
-import datetime
 def date_exists(year, month, day):
     try:
-        datetime.datetime(year, month, day)
+        datetime(year, month, day)
         return True
     except:
         return False
 
 
 def pull_sleep_dates(token, subject_id, years, months, days):
-    # Set filename
-    filename = raw_data_folder+"sleep_summary.csv"
-    summaries = pd.DataFrame(columns=sleep_columns)
-
-    for y in years:
-        for m in months:
-            for d in days:
-                if date_exists(y, m, d):
-                    try:
-                        pruned_data = pull_sleep_summary_date(token, subject_id, y, m, d)
-                        pruned_data = pd.DataFrame.from_dict([pruned_data])
-                        summaries = pd.concat([summaries, pruned_data], ignore_index=True)
-                    except Exception as e:
-                        print(e)
-        
-    summaries.to_csv(filename, mode='a', header=False)
+    ''' Pull the sleep summaries of every valid date in the given years,
+    months and days. Nights already stored are skipped, see backfill.py.
+
+    token : The oauth2 authorization token of the user
+    subject_id : The pseudonymous subject ID of the user
+    years, months, days : lists of the years, months and days of the dates
+    '''
+    import backfill
+
+    dates = [datetime(y, m, d).date() for y in years for m in months for d in days
+             if date_exists(y, m, d)]
+    backfill.backfill([(token, None, subject_id)], dates)
 
 
 def pull_sleep(token, user_id, subject_id):
@@ -645,34 +594,35 @@ def pull_sleep(token, user_id, subject_id):
     filename = raw_data_folder+"sleep_summary.csv"
 
     # Find the last date with data for this subject
-    data = pd.read_csv(filename, usecols=["date", "subject_id"])
-    data = data[data["subject_id"] == subject_id]
-    latest_date = max(pd.to_datetime(data['date']))
+    latest_date = state.latest(subject_id, 'sleep_summary', filename)
 
-    summaries = pd.DataFrame(columns=sleep_columns)
+    summaries = schema.of('sleep_summary').buffer()
 
-    # Now check for new
-    summary_list = sleep_list(token)
-    for summary in summary_list:
+    # Now check for new. The nights are decoded one at a time.
+    for summary in sleep_list(token):
         # Sleep reports don't change once generated. If the date is
         # already found, just skip
-        date = datetime.strptime(summary["date"], '%Y-%m-%d')
-        if date >= latest_date:
+        if latest_date is None or summary["date"] > latest_date:
 
             if 'heart_rate_samples' in summary:
-                utils.retry_and_report(handle_sleep_sample, subject_id, summary['date'], summary['heart_rate_samples'], type)
+                handle_sleep_sample(subject_id, summary['date'], summary['heart_rate_samples'], "heart rate")
 
             if 'hypnogram' in summary:
-                utils.retry_and_report(handle_sleep_sample, subject_id, summary['date'], summary['hypnogram'], type)
+                handle_sleep_sample(subject_id, summary['date'], summary['hypnogram'], "hypnogram")
 
             # Take only the given set of columns
-            pruned_data = utils.prune_data(summary, sleep_columns)
-            pruned_data['subject_id'] = subject_id
+            summaries.add(summary, subject_id=subject_id)
 
-            summaries = summaries.append(pruned_data, ignore_index=True)
+    # Write to the file. The latest date is noted once the rows are written.
+    if len(summaries) > 0:
+        latest_date = max(summaries.column('date'))
+        def written():
+            state.update(subject_id, 'sleep_summary', latest_date)
+            journal.journal().mark_done(subject_id, 'sleep')
 
-    # Write to the file
-    summaries.to_csv(filename, mode='a', header=False)
+        writer.write(filename, sleep_columns, summaries, after_flush=written)
+    else:
+        journal.journal().mark_done(subject_id, 'sleep')
 
 
 def handle_sleep_sample(subject_id, date, data, type):
@@ -688,22 +638,17 @@ def handle_sleep_sample(subject_id, date, data, type):
         print("handle_sleep_sample called with empty sample")
         return
 
-    # Read from the file or initialize an empty dataframe
     filename = raw_data_folder+"sleep_samples.csv"
-    columns = ['subject_id', 'date', 'sample-time', 'sample-type', 'sample']
-
-    samples = pd.DataFrame.from_dict([{
-                'subject_id': subject_id,
-                'date': date,
-                'sample-time': time,
-                'sample-type': type,
-                'sample': sample
-               } for time, sample in data.items])
+    samples = schema.of('sleep_samples').frame({
+        'subject_id': subject_id,
+        'date': date,
+        'sample-time': list(data.keys()),
+        'sample-type': type,
+        'sample': list(data.values())
+    })
 
-    # write to file
-    sampledata = pd.DataFrame(columns=columns)
-    sampledata = sampledata.append(samples, ignore_index=True)
-    sampledata.to_csv(filename, mode='a', header=False)
+    # write to file, resampled if set in settings.resample_mode
+    resample.write(filename, sleep_sample_columns, samples)
 
 
 def pull_nightly_recharge(token, user_id, subject_id):
@@ -717,31 +662,67 @@ def pull_nightly_recharge(token, user_id, subject_id):
     filename = raw_data_folder+"nightly_recharge_summary.csv"
 
     # Find the last date with data for this subject
-    data = pd.read_csv(filename, usecols=["date", "subject_id"])
-    data = data[data["subject_id"] == subject_id]
-    latest_date = max(pd.to_datetime(data['date']))
+    latest_date = state.latest(subject_id, 'nightly_recharge_summary', filename)
 
-    summaries = pd.DataFrame(columns=recharge_columns)
+    summaries = schema.of('nightly_recharge_summary').buffer()
 
-    # Now check for new
-    summary_list = recharge_list(token)
-    for summary in summary_list:
-        date = datetime.strptime(summary["date"], '%Y-%m-%d')
-        if date >= latest_date:
+    # Now check for new. The recharges are decoded one at a time.
+    for summary in recharge_list(token):
+        if latest_date is None or summary["date"] > latest_date:
             # Extract the hrv and breathing rate samples
             if 'hrv_samples' in summary:
-                utils.retry_and_report(handle_sleep_sample, subject_id, summary['date'], summary['hrv_samples'], type)
+                handle_sleep_sample(subject_id, summary['date'], summary['hrv_samples'], "hrv")
             if 'breathing_samples' in summary:
-                utils.retry_and_report(handle_sleep_sample, subject_id, summary['date'], summary['breathing_samples'], type)
+                handle_sleep_sample(subject_id, summary['date'], summary['breathing_samples'], "breathing rate")
 
             # Take only the given set of columns
-            pruned_data = utils.prune_data(summary, recharge_columns)
-            pruned_data['subject_id'] = subject_id
+            summaries.add(summary, subject_id=subject_id)
+
+    # Write to the file. The latest date is noted once the rows are written.
+    if len(summaries) > 0:
+        latest_date = max(summaries.column('date'))
+        def written():
+            state.update(subject_id, 'nightly_recharge_summary', latest_date)
+            journal.journal().mark_done(subject_id, 'recharge')
+
+        writer.write(filename, recharge_columns, summaries, after_flush=written)
+    else:
+        journal.journal().mark_done(subject_id, 'recharge')
+
+
+def defer_commit(subject_id, stream, commit):
+    ''' Commit a transaction once the rows of the subject are written, see
+    commit_deferred.
+
+    subject_id : the pseudonym of the subject
+    stream : the journal step of the transaction, for example 'activities'
+    commit : function committing the transaction
+    '''
+    with _deferred_lock:
+        _deferred.setdefault(subject_id, []).append((stream, commit))
 
-            summaries = summaries.append(pruned_data, ignore_index=True)
 
-    # Write to the file
-    summaries.to_csv(filename, mode='a', header=False)
+def commit_deferred(subject_id):
+    ''' Commit the transactions of a subject and mark their streams done in
+    the journal. The rows must be written before calling this. Failed
+    commits are recorded in the journal and in metrics.
+
+    returns : True if every commit succeeded
+    '''
+    with _deferred_lock:
+        commits = _deferred.pop(subject_id, [])
+
+    succeeded = True
+    for stream, commit in commits:
+        try:
+            commit()
+            journal.journal().mark_done(subject_id, stream)
+        except Exception as e:
+            print(f"Could not commit {stream} of {subject_id}:", e)
+            journal.journal().mark_failed(subject_id, stream, e)
+            metrics.observe_failure('commit_' + stream, subject_id, e)
+            succeeded = False
+    return succeeded
 
 
 def pull_subject_data(token, user_id, subject_id):
@@ -750,29 +731,144 @@ def pull_subject_data(token, user_id, subject_id):
 
     token : The oauth2 authorization token of the user
     user_id : The polar user ID of the user
+
+    Streams already finished in an interrupted run are skipped. A stream
+    that fails after all its retries is recorded in the journal, and the
+    subject is not finished. The time spent in each stream is recorded in
+    metrics. The transactions of the
+    subject are committed after the next flush of the writer that succeeds,
+    once all of its rows are written.
     '''
-    has_data = retry_and_report(pull_activities, token, user_id, subject_id)
+    run_journal = journal.journal()
+    if run_journal.is_done(subject_id, 'subject'):
+        return
+
+    failed = []
+
+    def timed(stream, pull_function):
+        finished = []
+
+        @functools.wraps(pull_function)
+        def pull(*args):
+            result = pull_function(*args)
+            finished.append(stream)
+            return result
+
+        start = time.perf_counter()
+        try:
+            return utils.retry_and_report(pull, token, user_id, subject_id)
+        finally:
+            metrics.observe_stage(stream, subject_id, time.perf_counter() - start)
+            if not finished:
+                failed.append(stream)
+                run_journal.mark_failed(subject_id, stream, "all tries failed")
+
+    if run_journal.is_done(subject_id, 'activities'):
+        has_data = True
+    else:
+        has_data = timed('activities', pull_activities)
+
     if has_data:
-      retry_and_report(pull_exercises, token, user_id, subject_id)
-      retry_and_report(pull_sleep, token, user_id, subject_id)
-      retry_and_report(pull_nightly_recharge, token, user_id, subject_id)
-      time.sleep(1)
+      for stream, pull_function in (('exercises', pull_exercises),
+                                    ('sleep', pull_sleep),
+                                    ('recharge', pull_nightly_recharge)):
+        if not run_journal.is_done(subject_id, stream):
+          timed(stream, pull_function)
+
+    # Commit the transactions once the rows are written. A subject with a
+    # failed stream or commit is not done, so it is pulled again on resume.
+    def commit():
+        if commit_deferred(subject_id) and not failed:
+            run_journal.mark_done(subject_id, 'subject')
+
+    writer.after_flush(commit)
+
+
+def pull_entry(entry):
+    ''' Pull all data of a registered user. Errors are reported and do not
+    stop the run.
+
+    entry : (token, polar_user_id, pseudonym), see token_registry
+    '''
+    token, user, subject_id = entry
+    try:
+        now = datetime.now()
+        print(now.strftime("%H:%M:%S:"), user)
+        pull_subject_data(token, int(user), int(subject_id))
+    except requests.exceptions.HTTPError as e:
+        print(e)
+        print(f"HTTP-error for {int(subject_id)}, could be revoked")
+    except Exception as e:
+        print(e)
+        print(f"above error encountered for {int(subject_id)}. Moving on.")
+
+
+def pull_all(token_filename, max_workers=max_subjects_in_flight, shards=1, shard=0,
+             resume=False):
+    ''' Pull data for every subject in the token file. Up to max_workers
+    subjects are pulled at the same time. Each subject is handled by a single
+    worker, so the activities -> exercises -> sleep -> recharge order of a
+    subject is kept.
+
+    token_filename : the tokens file
+    max_workers : maximum number of subjects pulled concurrently
+    shards : (Optional) number of shards the subjects are split into
+    shard : (Optional) the shard pulled by this process, see sharding.py
+    resume : (Optional) continue the last run if it was interrupted,
+             skipping the subjects it finished
+    '''
+    entries = token_registry.read_entries(token_filename)
+
+    # The rate limits depend on the number of registered users. They are
+    # shared by all shards.
+    ratelimit.limiter.configure(len(entries), share=1/shards)
+
+    report_file, prometheus = metrics_file, prometheus_file
+    if shards > 1:
+        import sharding
+        folder = sharding.configure(shard, shards)
+        entries = [entry for entry in entries
+                   if sharding.shard_of(entry[2], shards) == shard]
+        report_file = folder + "metrics.jsonl"
+        if prometheus:
+            base, extension = os.path.splitext(prometheus)
+            prometheus = f"{base}_shard{shard}{extension}"
+
+    # Keep the daily rollups up to date with the rows written
+    if rollup_file is not None:
+        import rollups
+        writer.on_write(rollups.update)
+
+    run_journal = journal.journal()
+    if run_journal.start(resume):
+        print("Continuing an interrupted run")
+
+    if max_workers <= 1:
+        for entry in entries:
+            pull_entry(entry)
+
+    else:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            # Consume the results so that unexpected errors are raised here
+            list(executor.map(pull_entry, entries))
+
+    # Write anything still buffered
+    writer.flush()
+    metrics.write(report_file, prometheus, run=run_journal.run, subjects=len(entries),
+                  workers=max_workers, shard=shard, shards=shards)
+    run_journal.end()
 
 
 # If run as a script, read the token file and pull all data
 if __name__ == "__main__":
-    token_file = open("tokens", "r")
-    for line in token_file:
-        token, user, subject_id = line.split(' ')
-        try:
-            now = datetime.now()
-            print(now.strftime("%H:%M:%S:"), user)
-            pull_subject_data(token, int(user), int(subject_id))
-            time.sleep(0.1)
-        except requests.exceptions.HTTPError as e:
-            print(e)
-            print(f"HTTP-error for {int(subject_id)}, could be revoked")
-        except Exception as e:
-            print(e)
-            print(f"above error encountered for {int(subject_id)}. Moving on.")
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Pull data of all registered users")
+    parser.add_argument('workers', type=int, nargs='?', default=max_subjects_in_flight,
+                        help="subjects pulled concurrently")
+    parser.add_argument('--shards', type=int, default=1, help="number of shards")
+    parser.add_argument('--shard', type=int, default=0, help="shard pulled by this process")
+    parser.add_argument('--resume', action='store_true', help="continue an interrupted run")
+    args = parser.parse_args()
 
+    pull_all("tokens", args.workers, args.shards, args.shard, args.resume)
@@ -0,0 +1,187 @@
+# When run as a script, fetch the sleep summaries of a date range for
+# registered users, for example when a new cohort joins:
+#
+#   python3 backfill.py 2021-01-01 2021-06-30 [pseudonym ...]
+#
+# Without pseudonyms, all users in the tokens file are backfilled. Nights
+# already in sleep_summary.csv are skipped, the rest are fetched concurrently
+# (max_backfill_in_flight at a time, within the shared rate limit) and written
+# with their heart rate and hypnogram samples. A backfill that was
+# interrupted can simply be run again.
+
+import os
+import sys
+from datetime import date, timedelta
+
+import schema
+import state
+import utils
+import writer
+from settings import raw_data_folder, sleep_columns, max_backfill_in_flight
+
+
+# Number of nights fetched before their summaries are passed to the writer
+chunk_size = 1000
+
+
+def stored_dates(subject_ids, filename=None):
+    ''' Find the nights already stored for the given subjects. The file is
+    read in chunks, so it does not need to fit in memory.
+
+    subject_ids : list of pseudonyms
+    filename : (Optional) the sleep summary csv file
+
+    returns : dictionary from pseudonym to a set of dates "YYYY-MM-DD"
+    '''
+    import compressed
+
+    if filename is None:
+        filename = raw_data_folder + "sleep_summary.csv"
+
+    dates = {int(subject_id): set() for subject_id in subject_ids}
+    data_filename = compressed.existing(filename)
+    if not os.path.exists(data_filename) or os.path.getsize(data_filename) == 0:
+        return dates
+
+    chunks = compressed.read_csv(filename, usecols=['subject_id', 'date'], dtype=str,
+                                 chunksize=1000000)
+    for chunk in chunks:
+        chunk = chunk.dropna()
+        subjects = chunk['subject_id'].astype(float).astype(int)
+        chunk = chunk[subjects.isin(dates)]
+        for subject_id, subject_dates in chunk.groupby(subjects)['date']:
+            dates[int(subject_id)].update(subject_dates)
+    return dates
+
+
+def date_range(start, end):
+    ''' All dates from start to end, inclusive
+
+    start, end : "YYYY-MM-DD" or datetime.date
+
+    returns : list of datetime.date
+    '''
+    if isinstance(start, str):
+        start = date.fromisoformat(start)
+    if isinstance(end, str):
+        end = date.fromisoformat(end)
+    return [start + timedelta(days=i) for i in range((end - start).days + 1)]
+
+
+def backfill(entries, dates, max_workers=max_backfill_in_flight):
+    ''' Fetch and write the sleep summaries and samples of the given nights
+    that are not stored yet.
+
+    entries : list of (token, polar_user_id, pseudonym)
+    dates : list of datetime.date
+    max_workers : number of nights fetched concurrently
+
+    returns : list of (pseudonym, date) that could not be fetched
+    '''
+    from acceslink import pull_sleep_summary_date
+
+    filename = raw_data_folder + "sleep_summary.csv"
+    entries = [(token, user, int(subject_id)) for token, user, subject_id in entries]
+    stored = stored_dates([subject_id for token, user, subject_id in entries], filename)
+
+    tasks = [(token, subject_id, night)
+             for token, user, subject_id in entries
+             for night in dates
+             if night.isoformat() not in stored[subject_id]]
+    print(f"{len(tasks)} nights to fetch")
+
+    # Rate limits and unavailable API are retried by the client. Nights
+    # that fail otherwise are reported, and fetched by the next backfill.
+    def fetch(task):
+        token, subject_id, night = task
+        try:
+            return pull_sleep_summary_date(token, subject_id, night.year, night.month, night.day)
+        except Exception as e:
+            print(f"Could not fetch {night} for {subject_id}:", e)
+            return False
+
+    failed = []
+    for first in range(0, len(tasks), chunk_size):
+        chunk = tasks[first:first + chunk_size]
+        results = utils.map_concurrent(fetch, chunk, max_workers)
+
+        summaries = schema.of('sleep_summary').buffer()
+        for (token, subject_id, night), record in zip(chunk, results):
+            if record is False:
+                failed.append((subject_id, night.isoformat()))
+            elif record is not None:
+                summaries.append(record)
+
+        writer.write(filename, sleep_columns, summaries)
+        print(f"{min(first + chunk_size, len(tasks))}/{len(tasks)} nights fetched")
+
+    writer.flush()
+    advance_watermarks(stored, dates, failed)
+    return failed
+
+
+def advance_watermarks(stored, dates, failed):
+    ''' Move the sleep watermark of each subject over the nights done right
+    after it, so the daily pull does not fetch them again. The watermark
+    only moves over consecutive nights that are stored or were backfilled.
+    If there is a gap between the watermark and the backfilled range, it
+    stays where it is, so the daily pull still fetches the nights in the gap.
+
+    stored : dictionary from pseudonym to the dates stored before the backfill
+    dates : the backfilled nights, datetime.date
+    failed : list of (pseudonym, date) that could not be fetched
+    '''
+    state_store = state.store()
+    failed = set(failed)
+    latest = {}
+    for subject_id, stored_nights in stored.items():
+        watermark = state_store.get(subject_id, 'sleep_summary')
+        if watermark is None:
+            continue
+        done = set(stored_nights)
+        done.update(night.isoformat() for night in dates
+                    if (subject_id, night.isoformat()) not in failed)
+        night = date.fromisoformat(watermark[:10]) + timedelta(days=1)
+        while night.isoformat() in done:
+            latest[subject_id] = night.isoformat()
+            night += timedelta(days=1)
+    state_store.update(latest, 'sleep_summary')
+
+
+def backfill_registered(start, end, subject_ids=None, token_filename="tokens"):
+    ''' Backfill a date range for registered users and report the nights
+    that failed.
+
+    start, end : first and last date, "YYYY-MM-DD"
+    subject_ids : (Optional) pseudonyms to backfill, all users by default
+    token_filename : the tokens file
+
+    returns : list of (pseudonym, date) that could not be fetched
+    '''
+    import ratelimit
+    import token_registry
+
+    registry = token_registry.TokenRegistry(token_filename)
+
+    # A subject with more than one token is backfilled with the latest one
+    if subject_ids:
+        entries = [registry.by_subject[int(subject_id)][-1] for subject_id in subject_ids]
+    else:
+        entries = [subject_entries[-1] for subject_entries in registry.by_subject.values()]
+
+    # The rate limits depend on the number of registered users
+    ratelimit.limiter.configure(len(registry))
+
+    failed = backfill(entries, date_range(start, end))
+    for subject_id, night in failed:
+        print("Failed:", subject_id, night)
+    return failed
+
+
+# If run as a script, backfill the given date range
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print("Usage: python3 backfill.py START END [pseudonym ...]")
+        sys.exit(1)
+
+    backfill_registered(sys.argv[1], sys.argv[2], sys.argv[3:])
@@ -0,0 +1,140 @@
+# When run as a script, measure the throughput of a full pull against a local
+# mock of the Acceslink API (mock_server.py), for example
+#
+#   python3 benchmark.py --users 50 --latency 0.02 --error-rate 0.01
+#
+# Reports subjects and requests per second, the median and 99th percentile
+# time to pull one subject and the peak memory use. The data is written to a
+# temporary folder, or the one given with --output.
+#
+# The mock server runs in its own process, so its work and memory are not
+# counted in the results. Use --rate-limit to make the server report lower
+# limits, which the client then paces its requests to.
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import mock_server
+
+
+def percentile(values, p):
+    ''' The p:th percentile of a list of values, by nearest rank '''
+    values = sorted(values)
+    if not values:
+        return 0.0
+    rank = min(len(values) - 1, max(0, int(round(p / 100 * len(values) + 0.5)) - 1))
+    return values[rank]
+
+
+def run(config, workers, output_folder):
+    ''' Run a full pull for all users of a mock server.
+
+    config : mock_server.MockConfig
+    workers : number of subjects pulled concurrently, None for the default
+              in settings.py
+    output_folder : folder for the data files
+
+    returns : dictionary of results
+    '''
+    server = subprocess.Popen(
+        [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mock_server.py'),
+         '0'] + config.arguments(), stdout=subprocess.PIPE, text=True)
+    try:
+        # The first line printed is "Serving on <url>"
+        api_url = server.stdout.readline().split()[-1]
+        return measure(config, workers, output_folder, api_url)
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def measure(config, workers, output_folder, api_url):
+    ''' Pull all users from a running mock server, see run '''
+    import requests
+
+    # The settings are read when the modules are first imported
+    os.environ['ACCESSLINK_API_URL'] = api_url
+    os.environ['RAW_DATA_FOLDER'] = output_folder.rstrip('/') + '/'
+    if 'settings' in sys.modules:
+        raise RuntimeError("run() must be called before the settings are imported")
+    import acceslink
+
+    if workers is None:
+        workers = acceslink.max_subjects_in_flight
+
+    token_filename = os.path.join(output_folder, 'tokens')
+    with open(token_filename, 'w') as token_file:
+        for user in range(1, config.users + 1):
+            token_file.write(f"token{user} {user} {1000 + user}\n")
+
+    # Time each subject
+    latencies = []
+    pull_subject_data = acceslink.pull_subject_data
+
+    def timed_pull_subject_data(token, user_id, subject_id):
+        start = time.perf_counter()
+        pull_subject_data(token, user_id, subject_id)
+        latencies.append(time.perf_counter() - start)
+
+    acceslink.pull_subject_data = timed_pull_subject_data
+
+    start = time.perf_counter()
+    acceslink.pull_all(token_filename, workers)
+    elapsed = time.perf_counter() - start
+
+    stats = requests.get(api_url.replace('/v3/users', '/mock/stats')).json()
+
+    data_bytes = sum(os.path.getsize(os.path.join(output_folder, name))
+                     for name in os.listdir(output_folder) if '.csv' in name)
+
+    return {
+        'users': config.users,
+        'workers': workers,
+        'seconds': elapsed,
+        'subjects_per_second': config.users / elapsed,
+        'requests': stats['requests'],
+        'requests_per_second': stats['requests'] / elapsed,
+        'injected_errors': stats['errors'],
+        'rate_limited': stats['rate_limited'],
+        'subject_seconds_p50': percentile(latencies, 50),
+        'subject_seconds_p99': percentile(latencies, 99),
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'data_mb': data_bytes / 1024**2,
+    }
+
+
+# If run as a script, run the benchmark and print the results
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark acceslink.py against a mock API")
+    mock_server.add_arguments(parser)
+    parser.add_argument('--workers', type=int, default=None, help="subjects pulled concurrently")
+    parser.add_argument('--output', default=None, help="folder for the data files")
+    parser.add_argument('--json', action='store_true', help="print the results as JSON")
+    args = parser.parse_args()
+
+    config = mock_server.config_of(args)
+
+    output_folder = args.output or tempfile.mkdtemp(prefix='polar_benchmark_')
+    os.makedirs(output_folder, exist_ok=True)
+
+    # Keep the progress output of the pull out of the report
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        results = run(config, args.workers, output_folder)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+    if args.json:
+        print(json.dumps(results))
+    else:
+        for name, value in results.items():
+            print(f"{name:>22}: {value:.3f}" if isinstance(value, float) else f"{name:>22}: {value}")
+        print(f"{'output':>22}: {output_folder}")
@@ -0,0 +1,254 @@
+''' Disk cache of API responses that do not change.
+
+Activity and exercise summaries and their samples do not change once they
+exist, but they are only available through a transaction. If pulling a
+transaction fails, it is not committed and the next attempt downloads all of
+it again. The cache keeps these responses on disk until the transaction is
+committed, so a retry only downloads what is still missing.
+
+Responses are keyed by their URL without the transaction ID, since a retry
+uses a new transaction. An activity summary is updated during its day, so
+summaries are always downloaded, and the samples of an activity are keyed
+by their URL and the created stamp of the summary. The bodies are stored by the hash of their content
+in cache_folder, with an SQLite index of the URLs, their user and the time
+they were last used. When the bodies take more than cache_size bytes, the
+least recently used are removed. Committing a transaction removes the
+responses of that user and transaction type.
+'''
+
+import hashlib
+import os
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+
+import client
+from settings import cache_folder, cache_size
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def key(url, version=None):
+    ''' The cache key of a url: the url without the transaction ID, and the
+    version of the resource if given
+    '''
+    url = re.sub(r'(-transactions)/\d+', r'\1', url)
+    if version is None:
+        return url
+    return f'{url}@{version}'
+
+
+def group(url):
+    ''' The user and transaction type of a url, for example "12/exercise",
+    or None if the url is not part of a transaction
+    '''
+    match = re.search(r'/users/(\d+)/(activity|exercise)-transactions/', url)
+    if match is None:
+        return None
+    return f'{match.group(1)}/{match.group(2)}'
+
+
+class ResponseCache:
+    ''' Response bodies on disk, indexed by url.
+
+    folder : folder of the cached bodies and the index
+    max_size : maximum total size of the bodies in bytes
+    '''
+
+    def __init__(self, folder, max_size):
+        self.folder = folder
+        self.max_size = max_size
+        os.makedirs(folder, exist_ok=True)
+
+        self.lock = threading.RLock()
+        self.connection = sqlite3.connect(os.path.join(folder, 'index.sqlite'),
+                                          timeout=60, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS entries ('
+                'key TEXT PRIMARY KEY, hash TEXT, grp TEXT, last_used REAL)')
+            self.connection.execute(
+                'CREATE INDEX IF NOT EXISTS entries_grp ON entries (grp)')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS bodies (hash TEXT PRIMARY KEY, size INTEGER)')
+
+    def path(self, content_hash):
+        return os.path.join(self.folder, content_hash[:2], content_hash)
+
+    def lookup(self, url, version=None):
+        ''' Return an open file of a cached body, or None if the url is not
+        cached
+        '''
+        entry_key = key(url, version)
+        with self.lock, self.connection:
+            row = self.connection.execute(
+                'SELECT hash FROM entries WHERE key = ?', (entry_key,)).fetchone()
+            if row is None:
+                return None
+            try:
+                body = open(self.path(row[0]), 'rb')
+            except FileNotFoundError:
+                self.connection.execute('DELETE FROM entries WHERE key = ?', (entry_key,))
+                return None
+            self.connection.execute(
+                'UPDATE entries SET last_used = ? WHERE key = ?', (time.time(), entry_key))
+        return body
+
+    def store(self, url, response, version=None):
+        ''' Write a response body to the cache as it is read.
+
+        url : the url of the response
+        response : requests.Response, requested with stream=True
+        version : (Optional) version of the resource, part of its key
+
+        returns : an open file of the body
+        '''
+        # Write to a temporary file first, the name depends on the content
+        content_hash = hashlib.sha256()
+        size = 0
+        with tempfile.NamedTemporaryFile(dir=self.folder, delete=False) as temp_file:
+            for chunk in response.iter_content(chunk_size=1024*1024):
+                temp_file.write(chunk)
+                content_hash.update(chunk)
+                size += len(chunk)
+        response.close()
+        content_hash = content_hash.hexdigest()
+
+        path = self.path(content_hash)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(temp_file.name, path)
+        body = open(path, 'rb')
+
+        with self.lock, self.connection:
+            self.connection.execute(
+                'INSERT INTO bodies (hash, size) VALUES (?, ?) '
+                'ON CONFLICT (hash) DO NOTHING', (content_hash, size))
+            self.connection.execute(
+                'INSERT INTO entries (key, hash, grp, last_used) VALUES (?, ?, ?, ?) '
+                'ON CONFLICT (key) DO UPDATE SET hash = excluded.hash, '
+                'last_used = excluded.last_used',
+                (key(url, version), content_hash, group(url), time.time()))
+            self.evict()
+        return body
+
+    def open(self, token, url, version=None):
+        ''' Return the body of a url from the cache, or download it.
+
+        token : The oauth2 authorization token of the user
+        url : url to fetch
+        version : (Optional) version of the resource, for example the
+                  created stamp of the activity summary of samples
+
+        returns : an open binary file of the body, or None if the API
+                  returned 204: no data. Responses without data are not
+                  cached.
+        '''
+        body = self.lookup(url, version)
+        if body is not None:
+            return body
+
+        r = download(token, url)
+        if r is None:
+            return None
+        return self.store(url, r, version)
+
+    def invalidate(self, user_id, kind):
+        ''' Remove the responses of a committed transaction
+
+        user_id : The polar user ID of the user
+        kind : 'activity' or 'exercise'
+        '''
+        with self.lock, self.connection:
+            self.connection.execute(
+                'DELETE FROM entries WHERE grp = ?', (f'{user_id}/{kind}',))
+            self.remove_unused()
+
+    def evict(self):
+        # Remove the least recently used entries until the bodies fit in
+        # max_size
+        total = self.connection.execute(
+            'SELECT coalesce(sum(size), 0) FROM bodies').fetchone()[0]
+        if total <= self.max_size:
+            return
+        entries = self.connection.execute(
+            'SELECT entries.key, bodies.size FROM entries JOIN bodies USING (hash) '
+            'ORDER BY last_used').fetchall()
+        removed = []
+        for entry_key, size in entries:
+            if total <= self.max_size:
+                break
+            removed.append((entry_key,))
+            total -= size
+        self.connection.executemany('DELETE FROM entries WHERE key = ?', removed)
+        self.remove_unused()
+
+    def remove_unused(self):
+        # Delete the bodies no entry refers to
+        unused = self.connection.execute(
+            'SELECT hash FROM bodies WHERE hash NOT IN (SELECT hash FROM entries)').fetchall()
+        for (content_hash,) in unused:
+            path = self.path(content_hash)
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            # Remove the hash prefix folder once it is empty
+            try:
+                os.rmdir(os.path.dirname(path))
+            except OSError:
+                pass
+        self.connection.executemany('DELETE FROM bodies WHERE hash = ?', unused)
+
+
+def cache():
+    ''' Return the shared cache, creating it on first use '''
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ResponseCache(cache_folder, cache_size)
+    return _cache
+
+
+def download(token, url):
+    ''' Download a url without the cache.
+
+    token : The oauth2 authorization token of the user
+    url : url to fetch
+
+    returns : a streamed requests.Response, or None if the API returned
+              204: no data
+    '''
+    r = client.get(token, url, stream=True)
+    r.raise_for_status()
+    if r.status_code == 204:
+        r.close()
+        return None
+    return r
+
+
+def open_url(token, url, version=None):
+    ''' Return the body of a url, from the cache if it is there. With the
+    cache disabled (cache_size 0), the response is returned as is.
+
+    token : The oauth2 authorization token of the user
+    url : url to fetch
+    version : (Optional) version of the resource, see ResponseCache.open
+
+    returns : an open binary file of the body or a streamed
+              requests.Response, or None if the API returned 204: no data
+    '''
+    if cache_size <= 0:
+        return download(token, url)
+    return cache().open(token, url, version)
+
+
+def invalidate(user_id, kind):
+    ''' Remove the responses of a committed transaction, see
+    ResponseCache.invalidate
+    '''
+    if cache_size > 0:
+        cache().invalidate(user_id, kind)
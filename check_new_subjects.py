@@ -6,9 +6,11 @@
 # error, the token is not removed from the new_tokens list, so that registration
 # is attempted again when running the script the next time.
 
-import requests
 import uuid
 
+import client
+import token_registry
+
 # URL to the Polar Acceslink API
 from settings import api_url
 
@@ -20,15 +22,10 @@ def register(token):
     id : (Optional) Desired ID of the user
     '''
 
-    headers = {
-        'Content-Type': 'application/json',
-        'Accept': 'application/json',
-        'Authorization': f'Bearer {token}'
-    }
     json = {"member-id": uuid.uuid4().hex}
 
     try:
-        r = requests.post(api_url, json=json, headers = headers)
+        r = client.post(token, api_url, json=json)
 
         if r.status_code == 409:
             print("User already registered", token)
@@ -48,36 +45,30 @@ def register(token):
     return True
 
 
-# If run as a script, read the token file and pull all data
-if __name__ == "__main__":
+def register_new(token_filename="tokens", new_filename="new_tokens",
+                 error_filename="register_token_errors"):
+    ''' Register the users in the new tokens file that are not in the tokens
+    file yet, and add them to it.
+
+    returns : list of the entries that failed
+    '''
     # read the current token file
-    registered_token_file = open("tokens", "r")
-    tokens = []
-    for line in registered_token_file:
-        token, user, subject_id = line.split(' ')
-        tokens.append(token)
-    registered_token_file.close()
-
-    # Open it for appending
-    registered_token_file = open("tokens", "a")
-    # Open the error file as well
-    errorfile = open("register_token_errors", "a")
-
-    # Now read the new token file and check for unregistered tokens
-    new_token_file = open("new_tokens", "r")
-    for line in new_token_file:
-        token, user, subject_id = line.split(' ')
-        if token not in tokens:
-            success = register(token)
-            if success:
-                # Succesfully registered. Add it to the list
-                registered_token_file.write(f"{token} {user} {subject_id}")
-            else:
-                # Failed to register. Add it to the error list
-                # (but it stays in the new token list and will be retried)
-                errorfile.write(f"{token} {user} {subject_id}")
-
-    # close the files
-    new_token_file.close()
-    registered_token_file.close()
-    errorfile.close()
+    registry = token_registry.TokenRegistry(token_filename)
+
+    # Now read the new token file and register the unregistered tokens
+    failed = registry.register(token_registry.read_entries(new_filename), register)
+
+    # Succesfully registered tokens are added to the list
+    registry.save()
+
+    # Failed to register. Add them to the error list
+    # (but they stay in the new token list and will be retried)
+    with open(error_filename, "a") as errorfile:
+        for token, user, subject_id in failed:
+            errorfile.write(f"{token} {user} {subject_id}\n")
+    return failed
+
+
+# If run as a script, register the new tokens
+if __name__ == "__main__":
+    register_new()
@@ -0,0 +1,115 @@
+''' Shared HTTP client for the Polar Acceslink API.
+
+All requests go through a single requests.Session, so connections to the API
+are pooled and kept alive between calls instead of opening a new TCP and TLS
+connection for every request. The session is shared by all tokens; the
+authorization header is added per request.
+
+Every request first waits for the shared rate limiter, and responses with
+status 429 or 503 are retried after the time requested by the API. The
+latency, size and status of every response is recorded in metrics.
+'''
+
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+import ratelimit
+from settings import http_pool_size, http_timeout, http_compression, http_retries, retry_backoff
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def session():
+    ''' Return the shared session, creating it on first use.
+
+    return : requests.Session with a connection pool of http_pool_size
+    '''
+    global _session
+    with _session_lock:
+        if _session is None:
+            new_session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=http_pool_size,
+                                  pool_maxsize=http_pool_size)
+            new_session.mount('https://', adapter)
+            new_session.mount('http://', adapter)
+            new_session.headers.update({
+                'Accept': 'application/json',
+                'Accept-Encoding': 'gzip, deflate' if http_compression else 'identity',
+            })
+            _session = new_session
+    return _session
+
+
+def close():
+    ''' Close the shared session and its pooled connections '''
+    global _session
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+            _session = None
+
+
+def request(method, token, url, **kwargs):
+    ''' Send a request authenticated with the given token.
+
+    method : HTTP method, for example 'GET'
+    token : The oauth2 authorization token of the user
+    url : url to request
+    kwargs : passed on to requests.Session.request
+
+    return : requests.Response
+    '''
+    headers = dict(kwargs.pop('headers', {}))
+    headers['Authorization'] = f'Bearer {token}'
+    kwargs.setdefault('timeout', http_timeout)
+
+    for attempt in range(http_retries + 1):
+        ratelimit.limiter.acquire()
+        start = time.perf_counter()
+        r = session().request(method, url, headers=headers, **kwargs)
+        ratelimit.limiter.update(r.headers)
+
+        # Streamed bodies are not read here, use the size sent by the API
+        size = r.headers.get('Content-Length')
+        if size is None and not kwargs.get('stream'):
+            size = len(r.content)
+        metrics.observe_request(method, url, r.status_code,
+                                time.perf_counter() - start, int(size or 0))
+
+        if r.status_code not in (429, 503) or attempt == http_retries:
+            return r
+
+        metrics.observe_retry(url, r.status_code)
+        r.close()
+
+        # Rate limited or temporarily unavailable. Pause all requests,
+        # not just this one, since the limits are shared.
+        wait = ratelimit.retry_after(r.headers, retry_backoff)
+        print(f"Status {r.status_code}, waiting {wait} seconds")
+        ratelimit.limiter.block(wait)
+
+
+def get(token, url, **kwargs):
+    ''' GET a url, see request '''
+    return request('GET', token, url, **kwargs)
+
+
+def post(token, url, **kwargs):
+    ''' POST to a url, see request '''
+    return request('POST', token, url, **kwargs)
+
+
+def put(token, url, **kwargs):
+    ''' PUT to a url, see request '''
+    return request('PUT', token, url, **kwargs)
+
+
+def delete(token, url, **kwargs):
+    ''' DELETE a url, see request '''
+    return request('DELETE', token, url, **kwargs)
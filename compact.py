@@ -0,0 +1,197 @@
+# When run as a script, remove duplicate rows from the data files in the raw
+# data folder. Give file names (for example activity_steps) to compact only
+# those files:
+#
+#   python3 compact.py [file ...]
+#
+# Rows are duplicates if they have the same natural key (settings.natural_keys),
+# and the last one in the file is kept. The order of the kept rows does not
+# change. Files larger than memory are handled by splitting the rows into
+# parts by a hash of the key, so each part is deduplicated on its own, and
+# merging the parts back in file order. Only the keys of a part are held in
+# memory, and a part with too many keys is deduplicated a subset of its keys
+# at a time. The file is replaced atomically once
+# the new version is complete. Compressed files (see compressed.py) are
+# written back compressed, in frames of about frame_size bytes.
+#
+# Do not run this while another process is appending to the data files.
+
+import csv
+import heapq
+import os
+import sys
+import tempfile
+import zlib
+
+import compressed
+import state
+import utils
+from settings import raw_data_folder, file_columns, natural_keys, compaction_memory
+
+
+# Uncompressed size of the frames of a compacted compressed file
+frame_size = 16*1024*1024
+
+# Approximate memory used by each key in the dictionary of a part, in
+# addition to the bytes of the key
+key_overhead = 150
+
+
+def key_positions(stream):
+    ''' Positions of the natural key columns in a row of a data file. The
+    first column of the files is the row index.
+    '''
+    columns = file_columns[stream]
+    return [columns.index(column) + 1 for column in natural_keys[stream]]
+
+
+def parse_key(line, positions):
+    ''' Return the natural key of a line as bytes '''
+    fields = next(csv.reader([line.decode()]))
+    return '\x1f'.join(fields[p] if p < len(fields) else '' for p in positions).encode()
+
+
+def keep_latest(part_name, positions, rows, parts, passes):
+    ''' Remove the rows of a part file that have a later row with the same
+    key. The last row of each key is found a subset of the keys at a time,
+    holding only the keys and row numbers in memory, and the rows kept are
+    then copied in a second pass.
+
+    part_name : the part file, lines of the line number and the row
+    positions : positions of the key columns in a row
+    rows : the number of rows in the part
+    parts : the number of parts, the rows of a part have the same hash
+            modulo parts
+    passes : the number of subsets of the keys
+
+    returns : the number of rows kept
+    '''
+    keep = bytearray(rows)
+    for subset in range(passes):
+        latest = {}
+        with open(part_name, 'rb') as part_file:
+            for row, record in enumerate(part_file):
+                key = parse_key(record.split(b'\t', 1)[1], positions)
+                if passes == 1 or zlib.crc32(key) // parts % passes == subset:
+                    latest[key] = row
+        for row in latest.values():
+            keep[row] = 1
+        del latest
+
+    kept_name = part_name + '.kept'
+    with open(part_name, 'rb') as part_file, open(kept_name, 'wb') as kept_file:
+        for row, record in enumerate(part_file):
+            if keep[row]:
+                kept_file.write(record)
+    os.replace(kept_name, part_name)
+    return sum(keep)
+
+
+def compact(filename, stream, memory=compaction_memory):
+    ''' Remove duplicate rows from a data file, keeping the last row with
+    each natural key.
+
+    filename : the csv data file, or its compressed version
+    stream : name of the data file, for example 'activity_steps'
+    memory : approximate memory to use for each part
+
+    returns : tuple of the number of rows read and the number of rows kept
+    '''
+    positions = key_positions(stream)
+    codec = compressed.codec_of(filename)
+    size = os.path.getsize(filename)
+    parts = max(1, size // memory + 1)
+    folder = os.path.dirname(os.path.abspath(filename))
+
+    with tempfile.TemporaryDirectory(dir=folder) as temp_folder:
+        # Split the rows into parts by the hash of their key. Each row is
+        # stored with its line number, which gives the order in the file.
+        part_files = [open(os.path.join(temp_folder, f'part{i}'), 'wb') for i in range(parts)]
+        part_rows = [0] * parts
+        key_bytes = [0] * parts
+        header = None
+        rows = 0
+        with compressed.open_data(filename) as data_file:
+            for line_number, line in enumerate(data_file):
+                if not line.endswith(b'\n'):
+                    # Incomplete last line of an interrupted write
+                    continue
+                if line_number == 0 and parse_key(line, positions).startswith(b'subject_id'):
+                    header = line
+                    continue
+                key = parse_key(line, positions)
+                part = zlib.crc32(key) % parts
+                part_files[part].write(b'%d\t%s' % (line_number, line))
+                part_rows[part] += 1
+                key_bytes[part] += len(key)
+                rows += 1
+            # Position in the file reached, for compressed files the end of
+            # the last complete frame
+            end = data_file.raw.end if codec else data_file.tell()
+        for part_file in part_files:
+            part_file.close()
+
+        # Keep the last row with each key in each part. The rows of a part
+        # are in file order, so they stay in order.
+        kept = 0
+        for i in range(parts):
+            part_memory = key_bytes[i] + part_rows[i] * key_overhead
+            passes = part_memory // memory + 1
+            kept += keep_latest(os.path.join(temp_folder, f'part{i}'), positions,
+                                part_rows[i], parts, passes)
+
+        # Merge the parts in file order
+        def read_part(i):
+            with open(os.path.join(temp_folder, f'part{i}'), 'rb') as part_file:
+                for record in part_file:
+                    line_number, line = record.split(b'\t', 1)
+                    yield int(line_number), line
+
+        output_name = os.path.join(folder, '.' + os.path.basename(filename) + '.compact')
+        with open(output_name, 'wb') as output:
+            lines = heapq.merge(*[read_part(i) for i in range(parts)])
+            if codec is None:
+                if header is not None:
+                    output.write(header)
+                for line_number, line in lines:
+                    output.write(line)
+            else:
+                frame = [header] if header is not None else []
+                frame_bytes = 0
+                for line_number, line in lines:
+                    frame.append(line)
+                    frame_bytes += len(line)
+                    if frame_bytes >= frame_size:
+                        output.write(compressed.compress(b''.join(frame), codec))
+                        frame, frame_bytes = [], 0
+                if frame:
+                    output.write(compressed.compress(b''.join(frame), codec))
+            complete = output.tell()
+
+            # Rows appended by this process while compacting are kept as is
+            with utils.write_lock:
+                with open(filename, 'rb') as data_file:
+                    data_file.seek(end)
+                    output.write(data_file.read())
+                output.flush()
+                os.fsync(output.fileno())
+                os.replace(output_name, filename)
+                if codec is not None:
+                    # Frames appended while compacting are checked on the
+                    # next append
+                    compressed.mark_complete(filename, complete)
+
+    # Positions in the old file are no longer valid
+    state.store().reset_offset(filename)
+    return rows, kept
+
+
+# If run as a script, compact the data files
+if __name__ == "__main__":
+    streams = sys.argv[1:] or list(natural_keys)
+    for stream in streams:
+        filename = compressed.existing(raw_data_folder + stream + ".csv")
+        if not os.path.exists(filename):
+            continue
+        rows, kept = compact(filename, stream)
+        print(f"{stream}: {rows} rows, {rows - kept} duplicates removed")
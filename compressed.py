@@ -0,0 +1,329 @@
+''' Compressed data files.
+
+The sample files can be written compressed (settings.compression). Every
+write is appended to the file as its own gzip member or zstd frame, so the
+files stay append-only and each frame can be decoded on its own. The
+concatenated frames decompress to the same csv text as the plain file, so
+the files can also be read with zcat or zstdcat. Compressed files have a .gz
+or .zst extension after .csv.
+
+When compression is switched on, a plain file written before is compressed
+into the new file, and removed, before rows are first written to the stream
+(see migrate). Reading does not migrate, so readers in other processes never
+change the files. Run this module as a script to migrate right away, while
+no pull is running:
+
+  python3 compressed.py
+
+If a write is interrupted, the file ends in an incomplete frame. It is
+removed before the next frame is appended, and ignored by the readers. The
+end of the complete frames is kept in the state store, so only frames
+appended after it need to be checked.
+'''
+
+import io
+import os
+import threading
+import zlib
+
+import state
+from settings import compression, compressed_streams
+
+
+extensions = {'gzip': '.gz', 'zstd': '.zst'}
+
+# Plain files already checked for migration. Only used with
+# utils.write_lock held.
+_migrated = set()
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError("zstd compression requires zstandard (pip install zstandard)")
+    return zstandard
+
+
+def path(filename):
+    ''' The name of a data file on disk. Compressed streams get the extension
+    of the compression.
+
+    filename : the csv data file, for example raw_data_folder+"activity_steps.csv"
+    '''
+    stream = os.path.basename(filename)[:-len('.csv')]
+    if compression is None or stream not in compressed_streams:
+        return filename
+
+    return filename + extensions[compression]
+
+
+def migrate_once(filename, compressed_filename):
+    ''' Migrate the plain file of a compressed stream, once per process.
+    Called before writing to the stream, with utils.write_lock held.
+    '''
+    if filename not in _migrated:
+        migrate(filename, compressed_filename)
+        _migrated.add(filename)
+
+
+def migrate(filename, compressed_filename, frame_size=16*1024*1024):
+    ''' Move the rows of a plain data file to the end of its compressed
+    file and remove the plain file. Progress is kept in the state store
+    after every frame, so an interrupted migration continues where it
+    stopped. Call this with utils.write_lock held, and not while another
+    process writes to the file.
+
+    filename : the plain csv file
+    compressed_filename : the compressed file
+    frame_size : uncompressed size of the frames written
+
+    returns : the size of the plain file
+    '''
+    if not os.path.exists(filename):
+        return 0
+    print(f"Compressing {filename} into {compressed_filename}")
+
+    state_store = state.store()
+    key = filename + ':migrated'
+    offset = state_store.get_offset(key)
+    with open(filename, 'rb') as data_file:
+        header = data_file.readline()
+        if not header.startswith(b',subject_id'):
+            header = b''
+        data_file.seek(max(offset, len(header)))
+        while True:
+            # Frames end at a line, an incomplete last line is dropped
+            block = data_file.read(frame_size) + data_file.readline()
+            block = block[:block.rfind(b'\n') + 1]
+            if not block:
+                break
+            append_frame(compressed_filename,
+                         lambda empty, block=block: header + block if empty else block)
+            offset = data_file.tell()
+            state_store.set_offset(key, offset)
+
+    # As in sharding.merge_file, rows may be duplicated but never skipped
+    state_store.reset_offset(key)
+    state_store.reset_offset(filename)
+    os.remove(filename)
+    if os.path.exists(filename + '.index'):
+        os.remove(filename + '.index')
+    return offset
+
+
+def existing(filename):
+    ''' The name of a data file on disk for reading. If the file does not
+    exist with the current compression setting, a version with another
+    compression is used.
+    '''
+    for name in [path(filename), filename] + [filename + e for e in extensions.values()]:
+        if os.path.exists(name):
+            return name
+    return path(filename)
+
+
+def codec_of(filename):
+    ''' The compression of a file by its extension, None if not compressed '''
+    for codec, extension in extensions.items():
+        if filename.endswith(extension):
+            return codec
+    return None
+
+
+def compress(payload, codec):
+    ''' Compress bytes into a single frame '''
+    if codec == 'gzip':
+        compressor = zlib.compressobj(wbits=31)
+        return compressor.compress(payload) + compressor.flush()
+    return _zstandard().ZstdCompressor().compress(payload)
+
+
+def _decompressobj(codec):
+    if codec == 'gzip':
+        return zlib.decompressobj(wbits=31)
+    return _zstandard().ZstdDecompressor().decompressobj()
+
+
+def decompress(data, codec):
+    ''' Decompress bytes holding one or more complete frames '''
+    parts = []
+    while data:
+        decompressor = _decompressobj(codec)
+        parts.append(decompressor.decompress(data))
+        data = decompressor.unused_data if decompressor.eof else b''
+    return b''.join(parts)
+
+
+def frames(filename, start=0, end=None, block_size=1 << 20):
+    ''' Iterate over the complete frames of a compressed file. An incomplete
+    or damaged last frame is ignored.
+
+    filename : the compressed file
+    start : position of the first frame to read
+    end : (Optional) stop reading at this position
+
+    returns : generator of (end position of the frame, decompressed bytes)
+    '''
+    codec = codec_of(filename)
+    with open(filename, 'rb') as data_file:
+        data_file.seek(start)
+        position = start
+        decompressor = _decompressobj(codec)
+        parts = []
+        while True:
+            size = block_size if end is None else min(block_size, end - position)
+            block = data_file.read(size) if size > 0 else b''
+            if not block:
+                return
+            while block:
+                try:
+                    parts.append(decompressor.decompress(block))
+                except Exception as e:
+                    print(f"Damaged frame in {filename} after byte {position}:", e)
+                    return
+                if not decompressor.eof:
+                    position += len(block)
+                    break
+                unused = decompressor.unused_data
+                position += len(block) - len(unused)
+                yield position, b''.join(parts)
+                decompressor = _decompressobj(codec)
+                parts = []
+                block = unused
+
+
+def complete_end(filename, start=0):
+    ''' The position after the last complete frame of a compressed file,
+    checking the frames from start on
+    '''
+    end = start
+    for end, payload in frames(filename, start):
+        pass
+    return end
+
+
+def _state_key(filename):
+    # The offsets of the state store are also used for scans of the same
+    # files, so the end of the complete frames has its own key
+    return filename + ':complete'
+
+
+def append(filename, data):
+    ''' Append a dataframe to a compressed file as a new frame. The first
+    frame starts with a header row. The caller holds the write lock.
+
+    filename : the compressed file
+    data : the dataframe to write
+    '''
+    import schema
+    append_frame(filename, lambda header: data.to_csv(
+        header=header, float_format=schema.float_format).encode())
+
+
+def append_frame(filename, payload):
+    ''' Append a frame to a compressed file, first removing an incomplete
+    frame left by an interrupted write. The caller holds the write lock.
+
+    filename : the compressed file
+    payload : function returning the uncompressed bytes of the frame. It is
+              called with True if the file has no complete frames, so the
+              frame should start with a header row.
+    '''
+    state_store = state.store()
+    end = state_store.get_offset(_state_key(filename))
+    with open(filename, 'ab+') as data_file:
+        size = data_file.seek(0, os.SEEK_END)
+        if end > size:
+            # The file was replaced, check all of it
+            end = 0
+        if size > end:
+            end = complete_end(filename, end)
+            if size > end:
+                data_file.truncate(end)
+        data_file.write(compress(payload(end == 0), codec_of(filename)))
+        data_file.flush()
+        os.fsync(data_file.fileno())
+        size = data_file.seek(0, os.SEEK_END)
+    state_store.set_offset(_state_key(filename), size)
+
+
+def mark_complete(filename, end):
+    ''' Record the end of the complete frames of a file, for example one
+    just rewritten
+    '''
+    state.store().set_offset(_state_key(filename), end)
+
+
+def forget(filename):
+    ''' Remove what is known of a file that is removed '''
+    state.store().reset_offset(_state_key(filename))
+
+
+class FrameReader(io.RawIOBase):
+    ''' A readable binary stream of the decompressed frames of a file '''
+
+    def __init__(self, filename, start=0, end=None):
+        self.frames = frames(filename, start, end)
+        self.buffer = memoryview(b'')
+        # The end of the last frame read
+        self.end = start
+
+    def readable(self):
+        return True
+
+    def readinto(self, target):
+        while len(self.buffer) == 0:
+            try:
+                self.end, payload = next(self.frames)
+                self.buffer = memoryview(payload)
+            except StopIteration:
+                return 0
+        size = min(len(target), len(self.buffer))
+        target[:size] = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        return size
+
+
+def open_data(filename, end=None):
+    ''' Open a data file for reading, decompressing it if needed.
+
+    filename : the data file on disk, see path
+    end : (Optional) for compressed files, read only the frames before
+          this position
+
+    returns : a binary file object
+    '''
+    if codec_of(filename) is None:
+        return open(filename, 'rb')
+    return io.BufferedReader(FrameReader(filename, end=end), buffer_size=1 << 20)
+
+
+def read_csv(filename, **kwargs):
+    ''' Read a data file with pandas.read_csv, decompressing it if needed.
+
+    filename : the csv data file, for example raw_data_folder+"activity_steps.csv".
+               The compressed file is used if the stream is compressed.
+    kwargs : passed on to pandas.read_csv, for example chunksize
+
+    returns : dataframe, or an iterator of dataframes with chunksize
+    '''
+    import pandas as pd
+    return pd.read_csv(open_data(existing(filename)), **kwargs)
+
+
+# If run as a script, compress the existing plain files of the compressed
+# streams
+if __name__ == "__main__":
+    from settings import raw_data_folder
+
+    import utils
+
+    if compression is None:
+        print("Set compression in settings.py first")
+    else:
+        for stream in compressed_streams:
+            filename = raw_data_folder + stream + ".csv"
+            with utils.write_lock:
+                migrate_once(filename, path(filename))
+            print(path(filename))
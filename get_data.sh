@@ -1,11 +1,7 @@
 #!/bin/bash
 
-python3 remove_deleted_subjects.py >> logs
-python3 check_new_subjects.py >> logs
-python3 acceslink.py >> logs
-./get_ids_with_data.sh > ids_with_data 
+python3 polar_get.py nightly >> logs
 
 echo done at $(date) >> logs
 
 #cp *.csv ~/raw_data/
-
@@ -0,0 +1,94 @@
+# When run as a script, print the pseudonym of every subject with activity
+# data and the latest date we have received data for them, one subject per
+# line:
+#
+#   pseudonym date
+#
+# The activity summary file is read in a single pass. The result and the
+# position reached are kept in the state database, so the next run only reads
+# rows appended since then. A compressed file is read one frame at a time.
+
+import os
+import sys
+
+import compressed
+import state
+from settings import raw_data_folder
+
+
+def update_latest(lines, latest):
+    ''' Update the latest date of each subject from complete csv lines '''
+    for line in lines:
+        fields = line.split(b',', 3)
+        if len(fields) < 3 or not fields[1] or fields[1] == b'subject_id':
+            continue
+        subject_id = int(float(fields[1]))
+        date = fields[2].decode()
+        if subject_id not in latest or date > latest[subject_id]:
+            latest[subject_id] = date
+
+
+def scan(filename, stream='ids_with_data', block_size=1 << 24):
+    ''' Read rows appended to the activity summary file since the last scan
+    and update the latest date of each subject.
+
+    filename : the activity summary csv file, or its compressed version
+    stream : name of the stream the dates are stored under
+    block_size : number of bytes read at a time
+
+    returns : dictionary from subject ID to the latest date
+    '''
+    state_store = state.store()
+    offset = state_store.get_offset(filename)
+
+    if not os.path.exists(filename):
+        return state_store.all(stream)
+
+    if offset > os.path.getsize(filename):
+        # The file was rewritten, for example by compaction. Start over.
+        offset = 0
+
+    latest = {}
+    if compressed.codec_of(filename) is not None:
+        for end, payload in compressed.frames(filename, offset):
+            update_latest(payload.splitlines(), latest)
+            offset = end
+        state_store.update_scan(filename, offset, latest, stream)
+        return state_store.all(stream)
+
+    with open(filename, 'rb') as data_file:
+        # A header row is skipped by update_latest. Files written before
+        # headers were added start with a data row.
+        data_file.seek(offset)
+
+        remainder = b''
+        while True:
+            block = data_file.read(block_size)
+            if not block:
+                break
+            block = remainder + block
+
+            # Only handle complete lines, the last one may still be written
+            end = block.rfind(b'\n') + 1
+            remainder = block[end:]
+            update_latest(block[:end].splitlines(), latest)
+            offset += end
+
+    state_store.update_scan(filename, offset, latest, stream)
+    return state_store.all(stream)
+
+
+def write_ids(output):
+    ''' Write the pseudonym and latest date of every subject with activity
+    data, one subject per line.
+
+    output : file object to write to
+    '''
+    latest = scan(compressed.path(raw_data_folder + "activity_summary.csv"))
+    for subject_id in sorted(latest, key=str):
+        output.write(f"{subject_id} {latest[subject_id]}\n")
+
+
+# If run as a script, print the ids with data
+if __name__ == "__main__":
+    write_ids(sys.stdout)
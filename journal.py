@@ -0,0 +1,143 @@
+''' Run journal for resuming interrupted runs.
+
+The journal is a file of JSON records, one per line, appended and synced to
+disk one record at a time. A run writes a start record, a record for every
+data stream of a subject that is finished, a record for every stream that
+failed, and an end record. A stream is only recorded as finished after its
+rows are written to the data files and its transaction is committed.
+
+If a run stops before writing its end record, it can be continued by
+starting the next run with resume set (polar_get.py pull --resume):
+streams and subjects already recorded as finished are skipped. Otherwise,
+for example in the nightly run, a new journal is started, so no subject
+is skipped because it was finished by an earlier run.
+'''
+
+import json
+import os
+import threading
+import time
+import uuid
+
+import utils
+from settings import journal_file
+
+
+_journal = None
+_journal_lock = threading.Lock()
+
+
+class Journal:
+    ''' The journal of the current run.
+
+    filename : the journal file
+    '''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.run = None
+        self.done = set()
+
+    def start(self, resume=False):
+        ''' Start a new run, or continue the last run if it did not finish
+        and resume is set.
+
+        resume : continue an interrupted run
+
+        returns : True if an interrupted run is continued
+        '''
+        with self.lock:
+            run, done, finished = self._read()
+            if resume and run is not None and not finished:
+                self.run = run
+                self.done = done
+                return True
+
+            self.run = uuid.uuid4().hex
+            self.done = set()
+
+            # Replace the old journal
+            temp_filename = self.filename + '.tmp'
+            with open(temp_filename, 'w') as journal:
+                journal.write(json.dumps(self._record('start')) + '\n')
+                journal.flush()
+                os.fsync(journal.fileno())
+            os.replace(temp_filename, self.filename)
+            return False
+
+    def _read(self):
+        # Read the records of the last run in the journal. A partially
+        # written last line is ignored.
+        run, done, finished = None, set(), False
+        if not os.path.exists(self.filename):
+            return run, done, finished
+
+        with open(self.filename) as journal:
+            for line in journal:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if record['event'] == 'start':
+                    run, done, finished = record['run'], set(), False
+                elif record['run'] != run:
+                    continue
+                elif record['event'] == 'done':
+                    done.add((record['subject'], record['stream']))
+                elif record['event'] == 'end':
+                    finished = True
+        return run, done, finished
+
+    def _record(self, event, **fields):
+        return dict(event=event, run=self.run, time=time.time(), **fields)
+
+    def _append(self, record):
+        with open(self.filename, 'ab+') as journal:
+            utils.remove_partial_line(journal)
+            journal.write((json.dumps(record) + '\n').encode())
+            journal.flush()
+            os.fsync(journal.fileno())
+
+    def is_done(self, subject_id, stream):
+        ''' Check if a stream of a subject is finished in this run '''
+        with self.lock:
+            return (int(subject_id), stream) in self.done
+
+    def mark_done(self, subject_id, stream):
+        ''' Record a stream of a subject as finished '''
+        with self.lock:
+            self.done.add((int(subject_id), stream))
+            self._append(self._record('done', subject=int(subject_id), stream=stream))
+
+    def mark_failed(self, subject_id, stream, error):
+        ''' Record that a stream of a subject could not be finished, for
+        example because its transaction could not be committed. The stream
+        is not done, so it is pulled again if the run is continued.
+        '''
+        with self.lock:
+            self._append(self._record('failed', subject=int(subject_id), stream=stream,
+                                      error=str(error)))
+
+    def end(self):
+        ''' Record that the run finished '''
+        with self.lock:
+            self._append(self._record('end'))
+
+
+def journal():
+    ''' Return the shared journal, creating it on first use '''
+    global _journal
+    with _journal_lock:
+        if _journal is None:
+            _journal = Journal(journal_file)
+    return _journal
+
+
+def use(filename):
+    ''' Use another journal file, for example the journal of a shard. Call
+    this before the journal is first used.
+    '''
+    global _journal
+    with _journal_lock:
+        _journal = Journal(filename)
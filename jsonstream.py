@@ -0,0 +1,87 @@
+''' Incremental decoding of JSON responses.
+
+Large responses, such as the sleep and recharge lists and the exercise
+samples, are decoded while they are read from the connection, so the raw
+body and the decoded document are not both held in memory. This uses ijson
+(see requirements.txt). Without it the whole response is decoded with
+response.json(), which gives the same results, and a message is printed
+once.
+
+The responses must be requested with stream=True. A binary file, such as
+a response body in the cache, can be decoded the same way. Responses and
+files are closed once decoded.
+'''
+
+import json
+
+
+_warned = False
+
+
+def _ijson():
+    global _warned
+    try:
+        import ijson
+    except ImportError:
+        if not _warned:
+            _warned = True
+            print("ijson is not installed, decoding whole JSON responses")
+        return None
+    return ijson
+
+
+def _decode(source):
+    # Decode a whole response or file without ijson
+    if hasattr(source, 'json'):
+        return source.json()
+    return json.load(source)
+
+
+def _raw(source):
+    # The byte stream of a response or file
+    if hasattr(source, 'raw'):
+        source.raw.decode_content = True
+        return source.raw
+    return source
+
+
+def items(response, path):
+    ''' Iterate over the items of an array in a JSON response, decoding one
+    item at a time.
+
+    response : requests.Response, requested with stream=True, or a binary
+               file
+    path : list of the keys leading to the array, for example ['nights']
+
+    returns : generator of the items, nothing if the array does not exist
+    '''
+    ijson = _ijson()
+    try:
+        if ijson is None:
+            data = _decode(response)
+            for key in path:
+                data = data.get(key, [])
+            yield from data
+        else:
+            prefix = '.'.join(path + ['item'])
+            yield from ijson.items(_raw(response), prefix, use_float=True)
+    finally:
+        response.close()
+
+
+def load(response):
+    ''' Decode a whole JSON response, without keeping a copy of the raw
+    body.
+
+    response : requests.Response, requested with stream=True, or a binary
+               file
+
+    returns : the decoded document
+    '''
+    ijson = _ijson()
+    try:
+        if ijson is None:
+            return _decode(response)
+        return next(ijson.items(_raw(response), '', use_float=True))
+    finally:
+        response.close()
@@ -0,0 +1,224 @@
+''' Run metrics.
+
+Collects latency histograms and counters for every API request and every
+write to the data files, and the time each subject spends in each stage.
+At the end of a run they are appended to metrics_file as JSON lines, and
+optionally written to prometheus_file in the Prometheus text format (for
+example for the node_exporter textfile collector).
+
+Metrics recorded:
+
+  request_seconds (histogram) : API request latency, by endpoint and method
+  requests_total (counter) : API responses, by endpoint, method and status class
+  response_bytes_total (counter) : bytes received, by endpoint
+  retries_total (counter) : requests retried after 429 or 503, by endpoint
+  write_seconds (histogram) : time to write a flush, by data file
+  rows_written_total (counter) : rows written, by data file
+  stage_seconds (histogram) : time a subject spends in a stage
+'''
+
+import json
+import os
+import re
+import threading
+import time
+
+from settings import metrics_file, prometheus_file
+
+
+# Upper bounds of the histogram buckets, in seconds
+buckets = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300]
+
+
+class Histogram:
+    __slots__ = ('counts', 'count', 'sum')
+
+    def __init__(self):
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        index = 0
+        while index < len(buckets) and value > buckets[index]:
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        ''' Cumulative counts by upper bound, the last bound is "+Inf" '''
+        total = 0
+        result = []
+        for bound, count in zip(buckets + ['+Inf'], self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+class Metrics:
+    ''' Histograms, counters and events of a run '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.histograms = {}
+        self.counters = {}
+        self.events = []
+
+    def observe(self, name, value, **labels):
+        ''' Add a value to a histogram '''
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    def increment(self, name, amount=1, **labels):
+        ''' Increase a counter '''
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def event(self, **fields):
+        ''' Record a structured event, written with the report '''
+        fields['time'] = time.time()
+        with self.lock:
+            self.events.append(fields)
+
+    def report(self, **run_fields):
+        ''' Return the metrics as a list of JSON serializable records.
+
+        run_fields : fields added to every record, for example the run ID
+        '''
+        now = time.time()
+        records = [dict(type='run', start=self.start_time, end=now,
+                        seconds=now - self.start_time, **run_fields)]
+        with self.lock:
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                records.append(dict(
+                    type='histogram', name=name, labels=dict(labels),
+                    count=histogram.count, sum=histogram.sum,
+                    buckets={str(bound): count for bound, count in histogram.cumulative()},
+                    **run_fields))
+            for (name, labels), value in sorted(self.counters.items()):
+                records.append(dict(type='counter', name=name, labels=dict(labels),
+                                    value=value, **run_fields))
+            for event in self.events:
+                records.append(dict(type='event', **event, **run_fields))
+        return records
+
+    def write_report(self, filename, **run_fields):
+        ''' Append the report to a JSON lines file '''
+        with open(filename, 'a') as report_file:
+            for record in self.report(**run_fields):
+                report_file.write(json.dumps(record) + '\n')
+
+    def write_prometheus(self, filename, prefix='polar_'):
+        ''' Write the histograms and counters in the Prometheus text format.
+        The file is replaced atomically, so a collector never reads a
+        partial file.
+        '''
+        def label_string(labels, **extra):
+            items = list(labels) + list(extra.items())
+            if not items:
+                return ''
+            return '{' + ','.join(f'{k}="{escape(v)}"' for k, v in items) + '}'
+
+        lines = []
+        with self.lock:
+            typed = set()
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                if name not in typed:
+                    lines.append(f'# TYPE {prefix}{name} histogram')
+                    typed.add(name)
+                for bound, count in histogram.cumulative():
+                    lines.append(f'{prefix}{name}_bucket{label_string(labels, le=bound)} {count}')
+                lines.append(f'{prefix}{name}_sum{label_string(labels)} {histogram.sum}')
+                lines.append(f'{prefix}{name}_count{label_string(labels)} {histogram.count}')
+            for (name, labels), value in sorted(self.counters.items()):
+                if name not in typed:
+                    lines.append(f'# TYPE {prefix}{name} counter')
+                    typed.add(name)
+                lines.append(f'{prefix}{name}{label_string(labels)} {value}')
+        lines.append(f'# TYPE {prefix}last_run_timestamp_seconds gauge')
+        lines.append(f'{prefix}last_run_timestamp_seconds {time.time()}')
+
+        temp_filename = filename + '.tmp'
+        with open(temp_filename, 'w') as prometheus:
+            prometheus.write('\n'.join(lines) + '\n')
+        os.replace(temp_filename, filename)
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def endpoint(url):
+    ''' Name of the endpoint of a url, with the IDs replaced, for example
+    /v3/users/{id}/activity-transactions/{id}
+    '''
+    path = re.sub(r'^[a-z]+://[^/]+', '', url).split('?')[0]
+    path = re.sub(r'/\d{4}-\d{2}-\d{2}(?=/|$)', '/{date}', path)
+    return re.sub(r'/\d+(?=/|$)', '/{id}', path)
+
+
+def observe_request(method, url, status, seconds, size):
+    ''' Record an API response '''
+    name = endpoint(url)
+    registry.observe('request_seconds', seconds, endpoint=name, method=method)
+    registry.increment('requests_total', endpoint=name, method=method, status=f'{status // 100}xx')
+    if size:
+        registry.increment('response_bytes_total', size, endpoint=name)
+
+
+def observe_retry(url, status):
+    ''' Record a request that is retried
+
+    url : the url of the request, or the name of a function that is retried
+          as a whole (see utils.retry_and_report)
+    status : the status code of the response, or the name of the error
+    '''
+    registry.increment('retries_total', endpoint=endpoint(url), status=str(status))
+
+
+def observe_write(filename, rows, seconds):
+    ''' Record rows written to a data file '''
+    name = os.path.basename(filename)
+    registry.observe('write_seconds', seconds, file=name)
+    registry.increment('rows_written_total', rows, file=name)
+
+
+def observe_stage(stage, subject_id, seconds):
+    ''' Record the time a subject spent in a stage '''
+    registry.observe('stage_seconds', seconds, stage=stage)
+    registry.event(event='stage', stage=stage, subject=int(subject_id), seconds=seconds)
+
+
+def observe_failure(stage, subject_id, error):
+    ''' Record a stage of a subject that failed, for example a commit '''
+    registry.increment('failures_total', stage=stage)
+    registry.event(event='failure', stage=stage, subject=int(subject_id), error=str(error))
+
+
+def observe_startup(command, seconds):
+    ''' Record the time from the start of the process to the start of the
+    work of a command
+    '''
+    registry.observe('startup_seconds', seconds, command=command)
+
+
+def write(filename=metrics_file, prometheus=prometheus_file, **run_fields):
+    ''' Write the report of the run
+
+    filename : JSON lines file to append the report to
+    prometheus : (Optional) file to write in the Prometheus text format
+    run_fields : fields added to every record
+    '''
+    registry.write_report(filename, **run_fields)
+    if prometheus:
+        registry.write_prometheus(prometheus)
+
+
+# The metrics of this process
+registry = Metrics()
@@ -0,0 +1,445 @@
+# A local stand-in for the parts of the Polar Acceslink API used by
+# acceslink.py, serving synthetic data. Used by benchmark.py, and can be run
+# on its own:
+#
+#   python3 mock_server.py [port] [--users N --latency S ...]
+#
+# and used by setting ACCESSLINK_API_URL=http://localhost:<port>/v3/users.
+# With port 0 a free port is picked; the first line printed gives the url.
+# GET /mock/stats returns the number of requests served and errors sent.
+#
+# Users are numbered from 1. The token of user n is "token<n>".
+
+import json
+import random
+import re
+import threading
+import time
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+
+class MockConfig:
+    ''' Configuration of the synthetic cohort and of the server behaviour.
+
+    users : number of users
+    days : number of days of activity and sleep data per user
+    activities_per_day : activity summaries per day in a transaction, only
+                         the last one is kept by the client
+    exercises : number of exercises per user
+    exercise_seconds : length of each exercise, one sample per second
+    no_data_fraction : fraction of users without any new data (status 204)
+    latency : seconds added to every response
+    error_rate : fraction of requests answered with 429 or 503
+    retry_after : Retry-After sent with the errors, in seconds
+    rate_limit : requests allowed in the short and long rate limit windows,
+                 sent as RateLimit-Limit. Requests over the limit are
+                 answered with 429 until the window ends.
+    rate_limit_windows : length of the short and long windows in seconds
+    seed : random seed of the synthetic data
+    '''
+
+    def __init__(self, users=10, days=7, activities_per_day=2, exercises=2,
+                 exercise_seconds=3600, no_data_fraction=0.0, latency=0.0,
+                 error_rate=0.0, retry_after=0.1, rate_limit=(1000000, 10000000),
+                 rate_limit_windows=(900, 86400), seed=0):
+        self.users = users
+        self.days = days
+        self.activities_per_day = activities_per_day
+        self.exercises = exercises
+        self.exercise_seconds = exercise_seconds
+        self.no_data_fraction = no_data_fraction
+        self.latency = latency
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.rate_limit = tuple(rate_limit)
+        self.rate_limit_windows = tuple(rate_limit_windows)
+        self.seed = seed
+
+    def arguments(self):
+        ''' The command line arguments of mock_server.py for this config '''
+        return ['--users', str(self.users), '--days', str(self.days),
+                '--activities-per-day', str(self.activities_per_day),
+                '--exercises', str(self.exercises),
+                '--exercise-seconds', str(self.exercise_seconds),
+                '--no-data', str(self.no_data_fraction), '--latency', str(self.latency),
+                '--error-rate', str(self.error_rate), '--retry-after', str(self.retry_after),
+                '--rate-limit', *map(str, self.rate_limit),
+                '--rate-limit-windows', *map(str, self.rate_limit_windows),
+                '--seed', str(self.seed)]
+
+
+def add_arguments(parser):
+    ''' Add the options of MockConfig to an argument parser '''
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--days', type=int, default=7)
+    parser.add_argument('--activities-per-day', type=int, default=2)
+    parser.add_argument('--exercises', type=int, default=2)
+    parser.add_argument('--exercise-seconds', type=int, default=3600)
+    parser.add_argument('--no-data', type=float, default=0.0, help="fraction of users without new data")
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds added to each response")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="fraction of 429/503 responses")
+    parser.add_argument('--retry-after', type=float, default=0.1, help="Retry-After of the errors")
+    parser.add_argument('--rate-limit', type=int, nargs=2, default=(1000000, 10000000),
+                        metavar=('SHORT', 'LONG'), help="requests allowed in each window")
+    parser.add_argument('--rate-limit-windows', type=int, nargs=2, default=(900, 86400),
+                        metavar=('SHORT', 'LONG'), help="length of the windows in seconds")
+    parser.add_argument('--seed', type=int, default=0)
+
+
+def config_of(args):
+    ''' The MockConfig of parsed arguments, see add_arguments '''
+    return MockConfig(
+        users=args.users, days=args.days, activities_per_day=args.activities_per_day,
+        exercises=args.exercises, exercise_seconds=args.exercise_seconds,
+        no_data_fraction=args.no_data, latency=args.latency, error_rate=args.error_rate,
+        retry_after=args.retry_after, rate_limit=args.rate_limit,
+        rate_limit_windows=args.rate_limit_windows, seed=args.seed)
+
+
+class MockAccesslink:
+    ''' The state of the mock API: users, their open transactions and what
+    they have committed.
+
+    config : MockConfig
+    '''
+
+    def __init__(self, config):
+        self.config = config
+        self.lock = threading.Lock()
+        self.random = random.Random(config.seed)
+        self.requests = 0
+        self.errors = 0
+        self.rate_limited = 0
+        self.started = time.monotonic()
+        self.windows = [(0, 0), (0, 0)]
+        self.transaction_ids = 0
+        self.transactions = {}
+        self.committed = set()
+        self.start_date = date(2021, 1, 1)
+        no_data = int(config.users * config.no_data_fraction)
+        self.users_without_data = set(range(1, no_data + 1))
+
+    def user_of_token(self, token):
+        user = int(token[len('token'):])
+        if not 1 <= user <= self.config.users:
+            raise KeyError(token)
+        return user
+
+    def use_rate_limit(self):
+        ''' Count a request in the rate limit windows.
+
+        returns : the rate limit headers of the response, and True if the
+                  request is over the limit
+        '''
+        elapsed = time.monotonic() - self.started
+        with self.lock:
+            over = False
+            for i, (length, limit) in enumerate(zip(self.config.rate_limit_windows,
+                                                    self.config.rate_limit)):
+                window, used = self.windows[i]
+                if int(elapsed // length) != window:
+                    window, used = int(elapsed // length), 0
+                self.windows[i] = (window, used + 1)
+                over = over or used + 1 > limit
+            if over:
+                self.rate_limited += 1
+            usage = [used for window, used in self.windows]
+
+        reset = [int(length - elapsed % length) + 1 for length in self.config.rate_limit_windows]
+        headers = {
+            'RateLimit-Usage': f'{usage[0]}, {usage[1]}',
+            'RateLimit-Limit': f'{self.config.rate_limit[0]}, {self.config.rate_limit[1]}',
+            'RateLimit-Reset': f'{reset[0]}, {reset[1]}',
+        }
+        return headers, over
+
+    def dates(self):
+        return [(self.start_date + timedelta(days=i)).isoformat()
+                for i in range(self.config.days)]
+
+    def open_transaction(self, user, kind):
+        ''' Return a new transaction ID, or None if there is no new data '''
+        with self.lock:
+            if user in self.users_without_data or (user, kind) in self.committed:
+                return None
+            self.transaction_ids += 1
+            self.transactions[self.transaction_ids] = (user, kind)
+            return self.transaction_ids
+
+    def commit(self, transaction):
+        with self.lock:
+            if transaction in self.transactions:
+                self.committed.add(self.transactions.pop(transaction))
+
+    def activity_summary(self, user, activity):
+        day, version = divmod(activity, self.config.activities_per_day)
+        rng = random.Random(user * 100000 + activity)
+        return {
+            'id': activity,
+            'polar-user': f'/v3/users/{user}',
+            'date': self.dates()[day],
+            'created': f'{self.dates()[day]}T{10 + version:02}:00:00.000',
+            'calories': rng.randint(1500, 3500),
+            'active-calories': rng.randint(100, 1500),
+            'duration': f'PT{rng.randint(10, 23)}H{rng.randint(0, 59)}M{rng.randint(0, 59)}S',
+            'active-steps': rng.randint(0, 20000),
+        }
+
+    def step_samples(self, user, activity):
+        rng = random.Random(user * 100000 + activity)
+        return {'interval': 60, 'samples': [
+            {'steps': rng.randint(0, 120), 'time': f'{h:02}:{m:02}:00.000'}
+            for h in range(24) for m in range(0, 60, 5)]}
+
+    def zone_samples(self, user, activity):
+        rng = random.Random(user * 100000 + activity)
+        return {'interval': 300, 'samples': [
+            {'time': f'{h:02}:00:00.000', 'activity-zones': [
+                {'index': index, 'inzone': f'PT{rng.randint(0, 59)}M{rng.randint(0, 59)}.{rng.randint(0, 999):03}S'}
+                for index in range(6)]}
+            for h in range(24)]}
+
+    def exercise_summary(self, user, exercise):
+        rng = random.Random(user * 1000 + exercise)
+        day = self.dates()[exercise % self.config.days]
+        return {
+            'id': exercise,
+            'start-time': f'{day}T{7 + exercise % 12:02}:00:00',
+            'calories': rng.randint(100, 1000),
+            'distance': rng.randint(1000, 20000),
+            'duration': f'PT{self.config.exercise_seconds // 3600}H{self.config.exercise_seconds % 3600 // 60}M',
+            'heart-rate': {'average': rng.randint(100, 150), 'maximum': rng.randint(150, 190)},
+            'training-load': rng.randint(10, 200),
+            'sport': 'RUNNING',
+            'detailed-sport-info': 'RUNNING',
+        }
+
+    def exercise_sample(self, user, exercise, sample_type):
+        rng = random.Random(user * 1000 + exercise * 10 + sample_type)
+        n = self.config.exercise_seconds
+        if sample_type == 0:
+            data = [str(rng.randint(90, 180)) for _ in range(n)]
+            rate = 1
+        elif sample_type == 10:
+            data = [f'{i * 2.8:.1f}' for i in range(n)]
+            rate = 1
+        else:
+            data = [str(rng.randint(350, 650)) for _ in range(n * 2)]
+            rate = 0
+        return {'recording-rate': rate, 'sample-type': str(sample_type), 'data': ','.join(data)}
+
+    def night(self, user, day):
+        rng = random.Random(user * 1000 + self.dates().index(day))
+        return {
+            'polar_user': f'/v3/users/{user}',
+            'date': day,
+            'sleep_start_time': f'{day}T23:00:00+02:00',
+            'sleep_end_time': f'{day}T07:00:00+02:00',
+            'continuity': round(rng.uniform(1, 5), 1),
+            'light_sleep': rng.randint(10000, 20000),
+            'deep_sleep': rng.randint(3000, 6000),
+            'rem_sleep': rng.randint(3000, 8000),
+            'unrecognized_sleep_stage': 0,
+            'total_interruption_duration': rng.randint(0, 3000),
+            'hypnogram': {f'{h:02}:{m:02}': rng.randint(0, 5) for h in range(8) for m in range(0, 60, 5)},
+            'heart_rate_samples': {f'{h:02}:{m:02}': rng.randint(40, 70) for h in range(8) for m in range(0, 60, 5)},
+        }
+
+    def recharge(self, user, day):
+        rng = random.Random(user * 1000 + self.dates().index(day) + 500)
+        return {
+            'polar_user': f'/v3/users/{user}',
+            'date': day,
+            'heart_rate_avg': rng.randint(40, 70),
+            'beat_to_beat_avg': rng.randint(800, 1200),
+            'heart_rate_variability_avg': rng.randint(20, 100),
+            'breathing_rate_avg': round(rng.uniform(10, 20), 1),
+            'nightly_recharge_status': rng.randint(1, 6),
+            'ans_charge': round(rng.uniform(-10, 10), 1),
+            'ans_charge_status': rng.randint(1, 5),
+            'hrv_samples': {f'{h:02}:{m:02}': rng.randint(20, 100) for h in range(4) for m in range(0, 60, 5)},
+            'breathing_samples': {f'{h:02}:{m:02}': round(rng.uniform(10, 20), 1) for h in range(4) for m in range(0, 60, 5)},
+        }
+
+
+class Handler(BaseHTTPRequestHandler):
+    ''' Routes requests to the MockAccesslink of the server '''
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    rate_limit_headers = {}
+
+    def send_json(self, status, body=None, headers=None):
+        data = b'' if body is None else json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in self.rate_limit_headers.items():
+            self.send_header(name, value)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def handle_request(self, method):
+        api = self.server.api
+        config = api.config
+
+        # Read any request body so the connection can be reused
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+
+        if method == 'GET' and urlparse(self.path).path == '/mock/stats':
+            self.rate_limit_headers = {}
+            return self.send_json(200, {'requests': api.requests, 'errors': api.errors,
+                                        'rate_limited': api.rate_limited})
+
+        self.rate_limit_headers, over = api.use_rate_limit()
+        if over:
+            reset = self.rate_limit_headers['RateLimit-Reset'].split(',')[0]
+            return self.send_json(429, headers={'Retry-After': reset})
+
+        with api.lock:
+            api.requests += 1
+            error = api.random.random() < config.error_rate
+            if error:
+                api.errors += 1
+        if config.latency:
+            time.sleep(config.latency)
+        if error:
+            status = 429 if api.random.random() < 0.5 else 503
+            return self.send_json(status, headers={'Retry-After': str(config.retry_after)})
+
+        try:
+            token = self.headers.get('Authorization', '').split(' ')[-1]
+            token_user = api.user_of_token(token)
+        except (KeyError, ValueError):
+            return self.send_json(401)
+
+        path = urlparse(self.path).path
+        base = f'http://{self.headers["Host"]}'
+        route = (method, path)
+
+        if route == ('POST', '/v3/users'):
+            return self.send_json(200, {'polar-user-id': token_user})
+
+        if method == 'GET' and path == '/v3/users/sleep':
+            if token_user in api.users_without_data:
+                return self.send_json(204)
+            return self.send_json(200, {'nights': [api.night(token_user, day) for day in api.dates()]})
+
+        match = re.fullmatch(r'/v3/users/sleep/(\d{4}-\d{2}-\d{2})', path)
+        if method == 'GET' and match:
+            if match[1] not in api.dates():
+                return self.send_json(204)
+            return self.send_json(200, api.night(token_user, match[1]))
+
+        if method == 'GET' and path == '/v3/users/nightly-recharge':
+            if token_user in api.users_without_data:
+                return self.send_json(204)
+            return self.send_json(200, {'recharges': [api.recharge(token_user, day) for day in api.dates()]})
+
+        match = re.fullmatch(r'/v3/users/(\d+)(?:/(activity|exercise)-transactions(?:/(\d+)(.*))?)?', path)
+        if match is None or int(match[1]) != token_user:
+            return self.send_json(404)
+        user, kind, transaction, rest = int(match[1]), match[2], match[3], match[4]
+
+        if kind is None:
+            if method == 'DELETE':
+                return self.send_json(204)
+            return self.send_json(404)
+
+        if transaction is None:
+            if method != 'POST':
+                return self.send_json(405)
+            transaction = api.open_transaction(user, kind)
+            if transaction is None:
+                return self.send_json(204)
+            return self.send_json(201, {'transaction-id': transaction,
+                                        'resource-uri': f'{base}{path}/{transaction}'})
+
+        transaction = int(transaction)
+        if transaction not in api.transactions:
+            return self.send_json(404)
+        prefix = f'{base}/v3/users/{user}/{kind}-transactions/{transaction}'
+
+        if method == 'PUT' and rest == '':
+            api.commit(transaction)
+            return self.send_json(200)
+
+        if method != 'GET':
+            return self.send_json(405)
+
+        if kind == 'activity':
+            if rest == '':
+                count = config.days * config.activities_per_day
+                return self.send_json(200, {'activity-log': [f'{prefix}/activities/{i}' for i in range(count)]})
+            match = re.fullmatch(r'/activities/(\d+)(/step-samples|/zone-samples)?', rest)
+            if match is None:
+                return self.send_json(404)
+            activity = int(match[1])
+            if match[2] == '/step-samples':
+                return self.send_json(200, api.step_samples(user, activity))
+            if match[2] == '/zone-samples':
+                return self.send_json(200, api.zone_samples(user, activity))
+            return self.send_json(200, api.activity_summary(user, activity))
+
+        if rest == '':
+            return self.send_json(200, {'exercises': [f'{prefix}/exercises/{i}' for i in range(config.exercises)]})
+        match = re.fullmatch(r'/exercises/(\d+)(/samples(?:/(\d+))?)?', rest)
+        if match is None:
+            return self.send_json(404)
+        exercise = int(match[1])
+        if match[3] is not None:
+            return self.send_json(200, api.exercise_sample(user, exercise, int(match[3])))
+        if match[2] is not None:
+            return self.send_json(200, {'samples': [f'{prefix}/exercises/{exercise}/samples/{t}' for t in (0, 10, 11)]})
+        return self.send_json(200, api.exercise_summary(user, exercise))
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def do_PUT(self):
+        self.handle_request('PUT')
+
+    def do_DELETE(self):
+        self.handle_request('DELETE')
+
+
+def start(config, port=0):
+    ''' Start a mock server in a background thread.
+
+    config : MockConfig
+    port : port to listen on, 0 picks a free port
+
+    returns : the server. Its api attribute holds the MockAccesslink, and
+              server.server_address[1] the port.
+    '''
+    server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    server.daemon_threads = True
+    server.api = MockAccesslink(config)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# If run as a script, serve until interrupted
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Serve a mock of the Acceslink API")
+    parser.add_argument('port', type=int, nargs='?', default=8000, help="0 picks a free port")
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    server = start(config_of(args), args.port)
+    print(f"Serving on http://127.0.0.1:{server.server_address[1]}/v3/users", flush=True)
+    threading.Event().wait()
@@ -0,0 +1,85 @@
+''' Partitioned Parquet output of the data files.
+
+When output_format is 'parquet' or 'both', each flush of the writer also
+writes the rows of each data file as Parquet, under
+
+  parquet_folder/<data file>/day=<YYYY-MM-DD>/[subject=<id>/]part-*.parquet
+
+Columns get the types of their schema (see schema.py), so analyses can read
+only the columns and days they need, for example
+
+  read('activity_steps', columns=['subject_id', 'steps'], start='2021-01-01')
+
+Requires pyarrow.
+'''
+
+import os
+import uuid
+
+import schema
+from settings import parquet_folder, parquet_partition_by_subject, date_columns
+
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("Parquet output requires pyarrow, install it or set output_format = 'csv'")
+    return pyarrow, pyarrow.parquet
+
+
+def stream_name(filename):
+    ''' Name of the data file without folder and extension '''
+    return os.path.basename(filename).split('.')[0]
+
+
+def write(filename, data):
+    ''' Write rows of a data file as Parquet, partitioned by day and
+    optionally subject.
+
+    filename : the csv file name of the data, used for the stream name
+    data : dataframe with the columns of the data file
+    '''
+    pyarrow, parquet = _pyarrow()
+
+    stream = stream_name(filename)
+    data = schema.of(stream).typed(data)
+    data['day'] = data[date_columns[stream]].str.slice(0, 10)
+    partition_cols = ['day']
+    if parquet_partition_by_subject:
+        data['subject'] = data['subject_id']
+        partition_cols.append('subject')
+
+    table = pyarrow.Table.from_pandas(data, preserve_index=False)
+    parquet.write_to_dataset(
+        table, root_path=os.path.join(parquet_folder, stream),
+        partition_cols=partition_cols,
+        basename_template=f'part-{uuid.uuid4().hex}-{{i}}.parquet')
+
+
+def read(stream, columns=None, start=None, end=None, subject_id=None):
+    ''' Read Parquet data of a stream. Only the requested columns and the
+    partitions in the date range are read.
+
+    stream : name of the data file, for example 'activity_steps'
+    columns : (Optional) list of columns to read
+    start : (Optional) first day to read, "YYYY-MM-DD"
+    end : (Optional) last day to read, "YYYY-MM-DD"
+    subject_id : (Optional) read only this subject
+
+    returns : dataframe
+    '''
+    import pandas as pd
+    _pyarrow()
+
+    filters = []
+    if start is not None:
+        filters.append(('day', '>=', start))
+    if end is not None:
+        filters.append(('day', '<=', end))
+    if subject_id is not None:
+        filters.append(('subject_id', '=', subject_id))
+
+    return pd.read_parquet(os.path.join(parquet_folder, stream), columns=columns,
+                           filters=filters or None)
@@ -0,0 +1,140 @@
+# Command line interface of all the steps of fetching the data, run in a
+# single process:
+#
+#   python3 polar_get.py register         register the users in new_tokens
+#   python3 polar_get.py delete           delete the users in delete_tokens
+#   python3 polar_get.py pull [WORKERS] [--shards N --shard K] [--resume]
+#   python3 polar_get.py ids-with-data [--output FILE]
+#   python3 polar_get.py backfill START END [pseudonym ...]
+#   python3 polar_get.py merge SHARDS     merge the files of sharded pulls
+#   python3 polar_get.py nightly          delete, register, pull and
+#                                         ids-with-data, as in get_data.sh
+#
+# The steps of nightly share the process, so the HTTP connections and the
+# state database are opened once. Modules are imported only by the commands
+# that use them, so small commands start quickly. The time taken to start
+# each command is printed, and recorded in the metrics of pulls.
+
+import time
+
+_start = time.perf_counter()
+_started = False
+
+import argparse
+import sys
+
+
+def startup(command):
+    ''' Report the time from the start of the script to the start of the
+    work of a command. Only the first command of the process is reported.
+    '''
+    global _started
+    if _started:
+        return
+    _started = True
+
+    import metrics
+    seconds = time.perf_counter() - _start
+    metrics.observe_startup(command, seconds)
+    print(f"{command}: started in {seconds:.3f} s")
+
+
+def register(args):
+    import check_new_subjects
+    startup('register')
+    failed = check_new_subjects.register_new(args.tokens)
+    print(f"{len(failed)} tokens could not be registered")
+
+
+def delete(args):
+    import remove_deleted_subjects
+    startup('delete')
+    failed = remove_deleted_subjects.delete_listed(args.tokens)
+    print(f"{len(failed)} users could not be deleted")
+
+
+def pull(args):
+    import acceslink
+    startup('pull')
+    acceslink.pull_all(args.tokens, args.workers, args.shards, args.shard, args.resume)
+
+
+def ids_with_data(args):
+    import ids_with_data
+    startup('ids-with-data')
+    if args.output is None:
+        ids_with_data.write_ids(sys.stdout)
+    else:
+        with open(args.output, 'w') as output:
+            ids_with_data.write_ids(output)
+
+
+def backfill(args):
+    import backfill
+    startup('backfill')
+    backfill.backfill_registered(args.start, args.end, args.pseudonyms, args.tokens)
+
+
+def merge(args):
+    import sharding
+    startup('merge')
+    print(f"Merged {sharding.merge(args.shards)} bytes")
+
+
+def nightly(args):
+    ''' The steps of get_data.sh: delete and register users, pull the data
+    and list the subjects with data
+    '''
+    startup('nightly')
+    args.shards, args.shard = 1, 0
+    args.resume = False
+    args.output = "ids_with_data"
+    for step in (delete, register, pull, ids_with_data):
+        step(args)
+
+
+def parser():
+    ''' The argument parser of the commands '''
+    from settings import max_subjects_in_flight
+
+    main_parser = argparse.ArgumentParser(
+        prog='polar_get.py', description="Fetch data from the Polar Acceslink API")
+    main_parser.add_argument('--tokens', default="tokens", help="the tokens file")
+    commands = main_parser.add_subparsers(dest='command', required=True)
+
+    commands.add_parser('register', help="register the users in new_tokens").set_defaults(run=register)
+    commands.add_parser('delete', help="delete the users in delete_tokens").set_defaults(run=delete)
+
+    command = commands.add_parser('pull', help="pull the data of all registered users")
+    command.add_argument('workers', type=int, nargs='?', default=max_subjects_in_flight,
+                         help="subjects pulled concurrently")
+    command.add_argument('--shards', type=int, default=1, help="number of shards")
+    command.add_argument('--shard', type=int, default=0, help="shard pulled by this process")
+    command.add_argument('--resume', action='store_true', help="continue an interrupted run")
+    command.set_defaults(run=pull)
+
+    command = commands.add_parser('ids-with-data', help="list the subjects with activity data")
+    command.add_argument('--output', help="write the list to this file")
+    command.set_defaults(run=ids_with_data)
+
+    command = commands.add_parser('backfill', help="fetch the sleep data of a date range")
+    command.add_argument('start', help="first date, YYYY-MM-DD")
+    command.add_argument('end', help="last date, YYYY-MM-DD")
+    command.add_argument('pseudonyms', nargs='*', help="subjects to backfill, all by default")
+    command.set_defaults(run=backfill)
+
+    command = commands.add_parser('merge', help="merge the data files of sharded pulls")
+    command.add_argument('shards', type=int, help="number of shards")
+    command.set_defaults(run=merge)
+
+    command = commands.add_parser('nightly', help="delete, register, pull and ids-with-data")
+    command.add_argument('workers', type=int, nargs='?', default=max_subjects_in_flight,
+                         help="subjects pulled concurrently")
+    command.set_defaults(run=nightly)
+
+    return main_parser
+
+
+if __name__ == "__main__":
+    args = parser().parse_args()
+    args.run(args)
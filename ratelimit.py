@@ -0,0 +1,148 @@
+''' Rate limiting for the Polar Acceslink API.
+
+The API limits the number of requests per client in two windows, a short one
+of 15 minutes and a long one of 24 hours. Both limits grow with the number of
+registered users and are shared by every user of the client, so a single
+limiter is shared by all requests of a run. Every request waits for a token
+from both buckets, and the buckets are corrected from the RateLimit headers
+returned by the API.
+'''
+
+import threading
+import time
+
+from settings import rate_limit_short, rate_limit_long
+
+
+class TokenBucket:
+    ''' Token bucket refilled at a constant rate, so that at most capacity
+    requests are made in any window of the given length.
+
+    capacity : number of requests allowed in a window
+    window : length of the window in seconds
+    '''
+
+    def __init__(self, capacity, window):
+        self.window = window
+        self.set_capacity(capacity)
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def set_capacity(self, capacity):
+        self.capacity = capacity
+        self.rate = capacity / self.window
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self):
+        ''' Seconds until the next token is available '''
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class RateLimiter:
+    ''' Paces requests to stay within the short and long term limits of
+    the API.
+
+    users : number of registered users, the limits grow with this number
+    '''
+
+    def __init__(self, users=0):
+        self.lock = threading.Lock()
+        self.short = TokenBucket(1, rate_limit_short['window'])
+        self.long = TokenBucket(1, rate_limit_long['window'])
+        self.blocked_until = 0
+        self.configure(users)
+
+    def configure(self, users, share=1):
+        ''' Set the limits for the given number of users.
+
+        users : number of registered users
+        share : fraction of the limits available to this process
+        '''
+        with self.lock:
+            self.share = share
+            for bucket, limit in ((self.short, rate_limit_short), (self.long, rate_limit_long)):
+                capacity = max(1, (limit['base'] + limit['per_user'] * users) * share)
+                bucket.set_capacity(capacity)
+                bucket.tokens = capacity
+
+    def acquire(self):
+        ''' Block until a request can be made '''
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.short.refill(now)
+                self.long.refill(now)
+                wait = max(self.blocked_until - now, self.short.wait_time(), self.long.wait_time())
+                if wait <= 0:
+                    self.short.tokens -= 1
+                    self.long.tokens -= 1
+                    return
+            time.sleep(wait)
+
+    def block(self, seconds):
+        ''' Stop all requests for the given number of seconds '''
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def update(self, headers):
+        ''' Correct the buckets from the rate limit headers of a response.
+        The limits reported by the API replace the configured ones, and the
+        usage it reports includes requests made by other processes, so the
+        buckets hold what is actually left.
+
+        headers : the response headers
+        '''
+        usage = parse_pair(headers.get('RateLimit-Usage'))
+        limit = parse_pair(headers.get('RateLimit-Limit'))
+        if usage is None or limit is None:
+            return
+
+        with self.lock:
+            now = time.monotonic()
+            for bucket, used, allowed in zip((self.short, self.long), usage, limit):
+                if allowed <= 0:
+                    continue
+                bucket.refill(now)
+                bucket.set_capacity(allowed * self.share)
+                bucket.tokens = min(bucket.capacity, (allowed - used) * self.share)
+
+
+def parse_pair(value):
+    ''' Parse a "short, long" rate limit header value
+
+    returns : a tuple of two integers, or None if the header is missing
+              or malformed
+    '''
+    if value is None:
+        return None
+    try:
+        short, long = value.split(',')
+        return int(short), int(long)
+    except ValueError:
+        return None
+
+
+def retry_after(headers, default):
+    ''' Number of seconds to wait after a 429 or 503 response. Uses the
+    Retry-After header, or the short window reset time from RateLimit-Reset.
+
+    headers : the response headers
+    default : returned if neither header is usable
+    '''
+    try:
+        return float(headers['Retry-After'])
+    except (KeyError, ValueError):
+        pass
+    reset = parse_pair(headers.get('RateLimit-Reset'))
+    if reset is not None:
+        return reset[0]
+    return default
+
+
+# The limiter shared by all requests
+limiter = RateLimiter()
@@ -0,0 +1,228 @@
+''' Reading the data files by subject and date.
+
+Returns the rows of one subject, or a date range, without reading the whole
+file. Each data file has a sidecar index, <data file>.index, an SQLite
+database of the byte ranges holding each subject and day. The index is
+brought up to date whenever the file is read, by indexing only the rows
+appended since the last read, and rebuilt if the file was rewritten (for
+example by compact.py). The ranges are read from a memory map of the file.
+
+For compressed files (see compressed.py) the ranges are the frames holding
+each subject and day, which are decompressed and filtered.
+
+The columns and their types come from schema.py, for example
+
+  read('activity_steps', subject_id=1001, start='2021-01-01', end='2021-01-31')
+'''
+
+import io
+import mmap
+import os
+import sqlite3
+
+import compressed
+from settings import raw_data_folder, file_columns, date_columns
+
+
+class Index:
+    ''' The sidecar index of a data file.
+
+    stream : name of the data file, for example 'activity_steps'
+    filename : (Optional) the data file on disk
+    '''
+
+    def __init__(self, stream, filename=None):
+        self.stream = stream
+        if filename is None:
+            filename = compressed.existing(raw_data_folder + stream + ".csv")
+        self.filename = filename
+        self.codec = compressed.codec_of(filename)
+        self.date_position = file_columns[stream].index(date_columns[stream]) + 1
+
+        self.connection = sqlite3.connect(filename + '.index', timeout=60)
+        with self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS ranges ('
+                'subject_id INTEGER, day TEXT, start INTEGER, end INTEGER)')
+            self.connection.execute(
+                'CREATE INDEX IF NOT EXISTS ranges_key ON ranges (subject_id, day)')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER)')
+
+    def close(self):
+        self.connection.close()
+
+    def _meta(self, key):
+        row = self.connection.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def _key(self, line):
+        # The subject and day of a csv line, None for the header row
+        fields = line.split(b',', self.date_position + 1)
+        if len(fields) <= self.date_position or fields[1] in (b'', b'subject_id'):
+            return None
+        return int(float(fields[1])), fields[self.date_position][:10].decode()
+
+    def _runs(self, offset, size):
+        # Yield (subject, day, start, end) for each run of lines with the
+        # same subject and day, from offset to the last complete line or
+        # frame. Returns the position reached.
+        if self.codec is not None:
+            for end, payload in compressed.frames(self.filename, offset):
+                keys = {self._key(line) for line in payload.splitlines()}
+                for key in keys:
+                    if key is not None:
+                        yield key[0], key[1], offset, end
+                offset = end
+            return offset
+
+        with open(self.filename, 'rb') as data_file:
+            data_file.seek(offset)
+            run_key, run_start = None, offset
+            position = offset
+            for line in data_file:
+                if not line.endswith(b'\n') or position + len(line) > size:
+                    break
+                key = self._key(line)
+                if key != run_key:
+                    if run_key is not None:
+                        yield run_key[0], run_key[1], run_start, position
+                    run_key, run_start = key, position
+                position += len(line)
+            if run_key is not None:
+                yield run_key[0], run_key[1], run_start, position
+            return position
+
+    def update(self, batch_size=100000):
+        ''' Index the rows appended since the last update. If the file was
+        replaced, the index is rebuilt.
+        '''
+        if not os.path.exists(self.filename):
+            return
+        status = os.stat(self.filename)
+        offset = self._meta('offset') or 0
+        if self._meta('inode') != status.st_ino or offset > status.st_size:
+            # A new or rewritten file
+            with self.connection:
+                self.connection.execute('DELETE FROM ranges')
+            offset = 0
+        if offset == status.st_size:
+            return
+
+        runs = self._runs(offset, status.st_size)
+        batch = []
+        while True:
+            try:
+                batch.append(next(runs))
+            except StopIteration as stop:
+                offset = stop.value
+                break
+            if len(batch) >= batch_size:
+                with self.connection:
+                    self.connection.executemany('INSERT INTO ranges VALUES (?, ?, ?, ?)', batch)
+                batch = []
+
+        with self.connection:
+            self.connection.executemany('INSERT INTO ranges VALUES (?, ?, ?, ?)', batch)
+            self.connection.executemany(
+                'INSERT INTO meta (key, value) VALUES (?, ?) '
+                'ON CONFLICT (key) DO UPDATE SET value = excluded.value',
+                [('offset', offset), ('inode', status.st_ino)])
+
+    def subjects(self):
+        ''' The pseudonyms with rows in the file, as of the last update '''
+        rows = self.connection.execute('SELECT DISTINCT subject_id FROM ranges ORDER BY subject_id')
+        return [row[0] for row in rows]
+
+    def ranges(self, subject_id=None, start=None, end=None):
+        ''' Byte ranges of the rows of a subject and day range, in file
+        order, with adjacent ranges joined.
+
+        subject_id : (Optional) the pseudonym
+        start : (Optional) first day, "YYYY-MM-DD"
+        end : (Optional) last day, "YYYY-MM-DD"
+
+        returns : list of (start, end)
+        '''
+        conditions, parameters = [], []
+        if subject_id is not None:
+            conditions.append('subject_id = ?')
+            parameters.append(int(subject_id))
+        if start is not None:
+            conditions.append('day >= ?')
+            parameters.append(start)
+        if end is not None:
+            conditions.append('day <= ?')
+            parameters.append(end)
+        where = ' WHERE ' + ' AND '.join(conditions) if conditions else ''
+        rows = self.connection.execute(
+            f'SELECT DISTINCT start, end FROM ranges{where} ORDER BY start', parameters).fetchall()
+
+        joined = []
+        for range_start, range_end in rows:
+            if joined and range_start <= joined[-1][1]:
+                joined[-1][1] = max(joined[-1][1], range_end)
+            else:
+                joined.append([range_start, range_end])
+        return [tuple(r) for r in joined]
+
+
+def read(stream, subject_id=None, start=None, end=None, columns=None):
+    ''' Read the rows of a data file for a subject and day range, with the
+    column types of its schema.
+
+    stream : name of the data file, for example 'activity_steps'
+    subject_id : (Optional) the pseudonym
+    start : (Optional) first day, "YYYY-MM-DD"
+    end : (Optional) last day, "YYYY-MM-DD"
+    columns : (Optional) list of columns to return
+
+    returns : dataframe
+    '''
+    import pandas as pd
+    import schema
+
+    # The first column is the row index. Repeated columns get a placeholder
+    # name, they are dropped.
+    names = ['']
+    for column in file_columns[stream]:
+        names.append(column if column not in names else f'{column} ({len(names)})')
+
+    index = Index(stream)
+    try:
+        index.update()
+        ranges = index.ranges(subject_id, start, end)
+    finally:
+        index.close()
+
+    chunks = []
+    if ranges:
+        with open(index.filename, 'rb') as data_file:
+            with mmap.mmap(data_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                for range_start, range_end in ranges:
+                    chunk = data[range_start:range_end]
+                    if index.codec is not None:
+                        chunk = compressed.decompress(chunk, index.codec)
+                    chunks.append(chunk)
+
+    if chunks:
+        data = pd.read_csv(io.BytesIO(b''.join(chunks)), header=None, names=names,
+                           dtype=str, keep_default_na=False)
+    else:
+        data = pd.DataFrame(columns=names, dtype=str)
+    data = data[[column for column in names if column in file_columns[stream]]]
+
+    # Drop header rows, and for compressed files the other rows of the frames
+    keep = data['subject_id'] != 'subject_id'
+    days = data[date_columns[stream]].str.slice(0, 10)
+    if subject_id is not None:
+        keep &= pd.to_numeric(data['subject_id'], errors='coerce') == int(subject_id)
+    if start is not None:
+        keep &= days >= start
+    if end is not None:
+        keep &= days <= end
+
+    data = schema.of(stream).typed(data[keep]).reset_index(drop=True)
+    if columns is not None:
+        data = data[columns]
+    return data
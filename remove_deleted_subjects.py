@@ -5,7 +5,8 @@
 # delete_token_errors. The token is also not deleted from the list, so that
 # deletion is attempted again the next time the script is run.
 
-import requests
+import client
+import token_registry
 
 # URL to the Polar Acceslink API
 from settings import api_url
@@ -18,13 +19,7 @@ def delete(token, user_id):
     user_id : The id of the user to remove
     '''
 
-    headers = {
-        'Content-Type': 'application/json',
-        'Accept': 'application/json',
-        'Authorization': f'Bearer {token}'
-    }
-
-    r = requests.delete(api_url + '/' + user_id, headers = headers)
+    r = client.delete(token, api_url + '/' + user_id)
 
     if r.status_code == 403:
         print("Access error, forbidden", token)
@@ -41,53 +36,33 @@ def delete(token, user_id):
     return True
 
 
-# If run as a script, read the token file and pull all data
-if __name__ == "__main__":
+def delete_listed(token_filename="tokens", delete_filename="delete_tokens",
+                  error_filename="delete_token_errors"):
+    ''' Delete the users listed in the delete file and remove them from the
+    tokens file. The delete file is emptied.
+
+    returns : list of the entries for which deleting failed
+    '''
     # read the current token file
-    registered_token_file = open("tokens", "r")
-    tokens = []
-    for line in registered_token_file:
-        token, user, subject_id = line.split(' ')
-        tokens.append((token, user, int(subject_id)))
-    registered_token_file.close()
-
-    # Open the error file as well
-    errorfile = open("delete_token_errors", "a")
-
-    # Now read the new token file and check for unregistered tokens
-    delete_token_file = open("delete_tokens", "r")
-    for line in delete_token_file:
-        delete_id = int(line)
-
-        # find the token and the user
-        token = None
-        user = None
-        for t, u, s in tokens:
-            if s == delete_id:
-                token = t
-                user = u
-
-        # remove the token from the list
-        tokens = [(t, u, s) for t, u, s in tokens if s != delete_id]
-
-        if token is not None:
-            success = delete(token, user)
-
-            if not success:
-                # Failed to delete. Add it to the error list
-                # (but it was removed from the list, so it will not be
-                # accessed)
-                errorfile.write(f"{token} {user} {delete_id}\n")
+    registry = token_registry.TokenRegistry(token_filename)
+
+    # Now read the delete file and remove the listed users
+    failed = registry.delete(token_registry.read_ids(delete_filename), delete)
 
     # Write tokens
-    registered_token_file = open("tokens", "w")
-    for t, u, s in tokens:
-        registered_token_file.write(f"{t} {u} {s}\n")
-    registered_token_file.close()
+    registry.save()
 
-    # close the files
-    delete_token_file.close()
-    errorfile.close()
+    # Failed to delete. Add them to the error list
+    # (but they were removed from the list, so they will not be accessed)
+    with open(error_filename, "a") as errorfile:
+        for token, user, subject_id in failed:
+            errorfile.write(f"{token} {user} {subject_id}\n")
 
     # remove the content of the delete file
-    open("delete_tokens", "w").close()
+    open(delete_filename, "w").close()
+    return failed
+
+
+# If run as a script, delete the listed users
+if __name__ == "__main__":
+    delete_listed()
@@ -0,0 +1,160 @@
+''' Resampling of the exercise and sleep samples.
+
+Most analyses only need the samples at a lower resolution than recorded,
+for example one heart rate value per minute. With settings.resample_mode set
+to 'alongside' or 'instead', the exercise and sleep samples are resampled
+to windows of resample_seconds as they are written, and written to
+exercise_samples_resampled.csv and sleep_samples_resampled.csv, in addition
+to or instead of the samples as recorded.
+
+Each window gets one row, with the samples combined by the function set for
+the sample type in settings.resample_functions (the mean by default), and
+the minimum, maximum and number of the samples. Sample types set to None,
+and exercise samples without a fixed recording rate (RR intervals), are
+written as recorded.
+'''
+
+import schema
+import writer
+from settings import resample_mode, resample_seconds, resample_functions, sample_names
+
+
+# The resampled file of each sample file
+resampled_streams = {
+    'exercise_samples': 'exercise_samples_resampled',
+    'sleep_samples': 'sleep_samples_resampled',
+}
+
+
+def _function(sample_type):
+    # The function combining the samples of a type, None to keep them
+    if sample_type.isdigit() and int(sample_type) < len(sample_names):
+        sample_type = sample_names[int(sample_type)]
+    return resample_functions.get(sample_type, 'mean')
+
+
+def _combine(samples, keys, window, function):
+    # One row for each series and window, with the samples combined by
+    # function and their minimum, maximum and number
+    grouped = samples.assign(window=window).groupby(keys + ['window'], sort=False, dropna=False)['sample']
+    return grouped.agg(**{'sample': function, 'sample-min': 'min', 'sample-max': 'max',
+                          'sample-count': 'count'}).reset_index()
+
+
+def _as_recorded(output, samples):
+    # Samples that are not resampled, in the columns of the resampled file
+    samples = samples.reset_index(drop=True)
+    return output.frame({column: samples[column] for column in samples.columns})
+
+
+def exercise_samples(data, seconds=resample_seconds):
+    ''' Resample exercise samples to windows of the given length.
+
+    data : dataframe of exercise_samples rows
+    seconds : length of the windows in seconds
+
+    returns : dataframe of exercise_samples_resampled rows. The sample-index
+              of a resampled row is the number of the window, and its
+              recording-rate the length of the window.
+    '''
+    import pandas as pd
+
+    output = schema.of('exercise_samples_resampled')
+    keys = ['subject_id', 'exercise-start-time', 'sample-type', 'sample-name']
+    parts = []
+    for sample_type, samples in data.groupby('sample-type', sort=False):
+        function = _function(sample_type)
+        rate = samples['recording-rate'].to_numpy(dtype='float64', na_value=0)
+        if function is None or not (rate > 0).all():
+            parts.append(_as_recorded(output, samples))
+            continue
+
+        window = samples['sample-index'].to_numpy(dtype='int64') * rate // seconds
+        resampled = _combine(samples, keys, window.astype('int64'), function)
+        parts.append(output.frame({
+            'subject_id': resampled['subject_id'],
+            'exercise-start-time': resampled['exercise-start-time'],
+            'sample-index': resampled['window'],
+            'recording-rate': seconds,
+            'sample-type': resampled['sample-type'],
+            'sample-name': resampled['sample-name'],
+            'sample': resampled['sample'],
+            'sample-min': resampled['sample-min'],
+            'sample-max': resampled['sample-max'],
+            'sample-count': resampled['sample-count'],
+        }))
+
+    if not parts:
+        return output.frame({})
+    return pd.concat(parts, ignore_index=True)[output.columns]
+
+
+def sleep_samples(data, seconds=resample_seconds):
+    ''' Resample sleep samples to windows of the given length.
+
+    data : dataframe of sleep_samples rows
+    seconds : length of the windows in seconds
+
+    returns : dataframe of sleep_samples_resampled rows. The sample-time of a
+              resampled row is the start of the window.
+    '''
+    import pandas as pd
+
+    output = schema.of('sleep_samples_resampled')
+    keys = ['subject_id', 'date', 'sample-type']
+    parts = []
+    for sample_type, samples in data.groupby('sample-type', sort=False):
+        function = _function(sample_type)
+        if function is None:
+            parts.append(_as_recorded(output, samples))
+            continue
+
+        # Sample times are HH:MM or HH:MM:SS
+        fields = samples['sample-time'].str.split(':', expand=True).astype('float64').fillna(0)
+        time = fields[0] * 3600 + fields[1] * 60
+        if fields.shape[1] > 2:
+            time += fields[2]
+        window = time.to_numpy(dtype='int64') // seconds * seconds
+        resampled = _combine(samples, keys, window, function)
+
+        if seconds % 60 == 0:
+            sample_time = [f'{start // 3600:02}:{start % 3600 // 60:02}'
+                           for start in resampled['window']]
+        else:
+            sample_time = [f'{start // 3600:02}:{start % 3600 // 60:02}:{start % 60:02}'
+                           for start in resampled['window']]
+        parts.append(output.frame({
+            'subject_id': resampled['subject_id'],
+            'date': resampled['date'],
+            'sample-time': sample_time,
+            'sample-type': resampled['sample-type'],
+            'sample': resampled['sample'],
+            'sample-min': resampled['sample-min'],
+            'sample-max': resampled['sample-max'],
+            'sample-count': resampled['sample-count'],
+        }))
+
+    if not parts:
+        return output.frame({})
+    return pd.concat(parts, ignore_index=True)[output.columns]
+
+
+def write(filename, columns, data):
+    ''' Write samples to a sample file, its resampled file, or both,
+    depending on settings.resample_mode.
+
+    filename : the sample file, for example raw_data_folder+"exercise_samples.csv"
+    columns : the columns of the sample file
+    data : dataframe of samples, typed with the schema of the file
+    '''
+    if resample_mode != 'instead':
+        writer.write(filename, columns, data)
+    if resample_mode == 'off':
+        return
+
+    stream = schema.of(filename).stream
+    resampled_stream = resampled_streams[stream]
+    resample_function = exercise_samples if stream == 'exercise_samples' else sleep_samples
+    resampled_filename = filename.replace(stream + '.csv', resampled_stream + '.csv')
+    writer.write(resampled_filename, schema.of(resampled_stream).columns,
+                 resample_function(data))
@@ -0,0 +1,238 @@
+''' Daily rollups of the sample files.
+
+Keeps small tables of the daily step totals, the minutes spent in each heart
+rate zone (settings.zone_names) per day, and the heart rate statistics of
+each exercise, in the SQLite database settings.rollup_file:
+
+  daily_steps (subject_id, date, steps, samples)
+  zone_minutes (subject_id, date, zone_index, zone_name, minutes)
+  exercise_heart_rate (subject_id, start_time, samples, mean, min, max)
+
+The tables are updated from the rows written in each run (see
+writer.on_write). The rows of a day or an exercise are always written
+together, so the rollup of a day or exercise is replaced by the one
+computed from its latest rows, as compact.py keeps the latest rows.
+
+When run as a script, the rollups are rebuilt from the full data files, one
+subject at a time (see reader.py):
+
+  python3 rollups.py [subject_id ...]
+'''
+
+import sqlite3
+import sys
+import threading
+
+from settings import rollup_file, natural_keys, sample_names, resample_mode
+
+
+_store = None
+_store_lock = threading.Lock()
+
+# The files the rollups are computed from. If only resampled exercise
+# samples are written, the heart rate statistics are computed from them.
+if resample_mode == 'instead':
+    streams = ['activity_steps', 'activity_zones', 'exercise_samples_resampled']
+else:
+    streams = ['activity_steps', 'activity_zones', 'exercise_samples']
+
+# The sample type of heart rate in exercise samples
+heart_rate_type = str(sample_names.index('Heart rate (bpm)'))
+
+
+def daily_steps(data):
+    ''' Steps per subject and day
+
+    data : dataframe of activity_steps rows
+    '''
+    return data.groupby(['subject_id', 'date'], as_index=False).agg(
+        steps=('steps', 'sum'), samples=('steps', 'size'))
+
+
+def zone_minutes(data):
+    ''' Minutes in each heart rate zone per subject and day
+
+    data : dataframe of activity_zones rows
+    '''
+    minutes = data.groupby(['subject_id', 'date', 'zone index', 'zone name'],
+                           as_index=False)['duration'].sum()
+    minutes['duration'] = minutes['duration'] / 60
+    return minutes
+
+
+def exercise_heart_rate(data):
+    ''' Number, mean, minimum and maximum of the heart rate samples of each
+    exercise
+
+    data : dataframe of exercise_samples or exercise_samples_resampled rows
+    '''
+    data = data[data['sample-type'] == heart_rate_type]
+    if 'sample-count' not in data.columns:
+        return data.groupby(['subject_id', 'exercise-start-time'], as_index=False)['sample'].agg(
+            ['count', 'mean', 'min', 'max'])
+
+    # Resampled samples, the mean is weighted by the samples in each window
+    data = data.assign(total=data['sample'] * data['sample-count'])
+    statistics = data.groupby(['subject_id', 'exercise-start-time'], as_index=False).agg(
+        count=('sample-count', 'sum'), total=('total', 'sum'),
+        min=('sample-min', 'min'), max=('sample-max', 'max'))
+    statistics['total'] = statistics['total'] / statistics['count']
+    return statistics.rename(columns={'total': 'mean'})
+
+
+def _rows(data):
+    # The rows of a rollup dataframe as python values, None for missing
+    import pandas as pd
+    columns = [[None if pd.isna(value) else value for value in data[column].tolist()]
+               for column in data.columns]
+    return list(zip(*columns))
+
+
+class RollupStore:
+    ''' The rollup tables.
+
+    filename : the SQLite database file
+    '''
+
+    def __init__(self, filename):
+        self.lock = threading.RLock()
+        self.connection = sqlite3.connect(filename, timeout=60, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS daily_steps ('
+                'subject_id INTEGER, date TEXT, steps INTEGER, samples INTEGER, '
+                'PRIMARY KEY (subject_id, date))')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS zone_minutes ('
+                'subject_id INTEGER, date TEXT, zone_index INTEGER, zone_name TEXT, '
+                'minutes REAL, PRIMARY KEY (subject_id, date, zone_index))')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS exercise_heart_rate ('
+                'subject_id INTEGER, start_time TEXT, samples INTEGER, '
+                'mean REAL, min REAL, max REAL, PRIMARY KEY (subject_id, start_time))')
+
+    def update(self, stream, data):
+        ''' Replace the rollups of the days or exercises in rows of a file.
+
+        stream : name of the data file, for example 'activity_steps'
+        data : dataframe of rows of the file
+        '''
+        if stream not in streams or len(data) == 0:
+            return
+        data = data.drop_duplicates(natural_keys[stream], keep='last')
+
+        with self.lock, self.connection:
+            if stream == 'activity_steps':
+                self.connection.executemany(
+                    'INSERT OR REPLACE INTO daily_steps VALUES (?, ?, ?, ?)',
+                    _rows(daily_steps(data)))
+
+            elif stream == 'activity_zones':
+                # A zone missing from the latest rows of a day is removed
+                days = _rows(data[['subject_id', 'date']].drop_duplicates())
+                self.connection.executemany(
+                    'DELETE FROM zone_minutes WHERE subject_id = ? AND date = ?', days)
+                self.connection.executemany(
+                    'INSERT OR REPLACE INTO zone_minutes VALUES (?, ?, ?, ?, ?)',
+                    _rows(zone_minutes(data)))
+
+            else:
+                self.connection.executemany(
+                    'INSERT OR REPLACE INTO exercise_heart_rate VALUES (?, ?, ?, ?, ?, ?)',
+                    _rows(exercise_heart_rate(data)))
+
+    def remove(self, subject_id):
+        ''' Remove all rollups of a subject '''
+        with self.lock, self.connection:
+            for table in ('daily_steps', 'zone_minutes', 'exercise_heart_rate'):
+                self.connection.execute(f'DELETE FROM {table} WHERE subject_id = ?',
+                                        (int(subject_id),))
+
+    def read(self, table, subject_id=None, start=None, end=None):
+        ''' Read a rollup table.
+
+        table : 'daily_steps', 'zone_minutes' or 'exercise_heart_rate'
+        subject_id : (Optional) the pseudonym
+        start : (Optional) first day, "YYYY-MM-DD"
+        end : (Optional) last day, "YYYY-MM-DD"
+
+        returns : dataframe
+        '''
+        import pandas as pd
+
+        day = 'substr(start_time, 1, 10)' if table == 'exercise_heart_rate' else 'date'
+        conditions, parameters = [], []
+        if subject_id is not None:
+            conditions.append('subject_id = ?')
+            parameters.append(int(subject_id))
+        if start is not None:
+            conditions.append(f'{day} >= ?')
+            parameters.append(start)
+        if end is not None:
+            conditions.append(f'{day} <= ?')
+            parameters.append(end)
+        where = ' WHERE ' + ' AND '.join(conditions) if conditions else ''
+        with self.lock:
+            return pd.read_sql_query(f'SELECT * FROM {table}{where} ORDER BY 1, 2',
+                                     self.connection, params=parameters)
+
+
+def store():
+    ''' Return the shared rollup store, opening it on first use '''
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = RollupStore(rollup_file)
+    return _store
+
+
+def update(filename, data):
+    ''' Update the rollups from rows written to a data file. Used as a
+    writer.on_write hook.
+
+    filename : the data file
+    data : dataframe of the rows written
+    '''
+    import schema
+    stream = schema.of(filename).stream
+    if stream in streams:
+        store().update(stream, data)
+
+
+def read(table, subject_id=None, start=None, end=None):
+    ''' Read a rollup table, see RollupStore.read '''
+    return store().read(table, subject_id, start, end)
+
+
+def rebuild(subject_ids=None):
+    ''' Rebuild the rollups from the full data files.
+
+    subject_ids : (Optional) rebuild only these subjects
+
+    returns : number of subjects rebuilt
+    '''
+    import reader
+
+    rollup_store = store()
+    if subject_ids is None:
+        subject_ids = set()
+        for stream in streams:
+            index = reader.Index(stream)
+            try:
+                index.update()
+                subject_ids.update(index.subjects())
+            finally:
+                index.close()
+
+    subject_ids = sorted(int(subject_id) for subject_id in subject_ids)
+    for subject_id in subject_ids:
+        rollup_store.remove(subject_id)
+        for stream in streams:
+            rollup_store.update(stream, reader.read(stream, subject_id=subject_id))
+    return len(subject_ids)
+
+
+# If run as a script, rebuild the rollups
+if __name__ == "__main__":
+    rebuilt = rebuild(sys.argv[1:] or None)
+    print(f"Rebuilt the rollups of {rebuilt} subjects")
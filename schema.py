@@ -0,0 +1,172 @@
+''' Schemas of the data files.
+
+Each data file has a schema: its columns in file order, and the type of each
+column from settings.column_types (columns not listed are strings). The pull
+functions collect rows in a ColumnBuffer, which keeps one list per column,
+and the lists are converted to typed columns all at once when the rows are
+written. A value that is missing, or that cannot be converted, becomes a
+missing value (<NA>) and is written as an empty field.
+
+Numbers are written with float_format, so whole numbers are written without
+a decimal point whatever the type of their column, and the same value is
+always written the same way.
+'''
+
+import os
+
+from settings import file_columns, column_types
+
+
+# Format of numbers in the csv files: up to 15 significant digits, which is
+# all a float holds exactly, and no trailing ".0"
+float_format = '%.15g'
+
+
+class Schema:
+    ''' The columns and column types of a data file.
+
+    stream : name of the data file, for example 'activity_steps'
+    columns : the columns of the file, in order. A column may be repeated,
+              the repeats hold the same values.
+    '''
+
+    def __init__(self, stream, columns):
+        self.stream = stream
+        self.columns = columns
+        self.fields = list(dict.fromkeys(columns))
+        self.types = {field: column_types.get(field, 'string') for field in self.fields}
+
+    def record(self, source, **values):
+        ''' A row as a tuple in the order of fields, see ColumnBuffer.add '''
+        return tuple(values[field] if field in values else source.get(field)
+                     for field in self.fields)
+
+    def buffer(self):
+        ''' A new, empty ColumnBuffer for rows of this file '''
+        return ColumnBuffer(self)
+
+    def column(self, field, values):
+        ''' Convert the values of a column to its type.
+
+        field : the column
+        values : list, array or series of the values
+
+        returns : series
+        '''
+        import pandas as pd
+
+        kind = self.types.get(field, 'string')
+        if getattr(values, 'dtype', None) == kind:
+            return values
+        if kind == 'string':
+            values = pd.Series(values, dtype=object).astype('string')
+            return values.mask(values == '')
+
+        values = pd.to_numeric(pd.Series(values, dtype=object), errors='coerce')
+        try:
+            return values.astype(kind)
+        except TypeError:
+            # Fractions in an integer column are kept rather than cut off
+            print(f"Column {field} of {self.stream} is not {kind}")
+            return values.astype('Float64')
+
+    def frame(self, columns):
+        ''' Build a dataframe of the file from whole columns.
+
+        columns : dictionary from field to a list or array of values, or a
+                  single value repeated on every row. Fields not given are
+                  missing on every row.
+
+        returns : dataframe with the columns of the file, in order
+        '''
+        import pandas as pd
+
+        length = max((len(values) for values in columns.values()
+                      if pd.api.types.is_list_like(values)), default=0)
+        data = pd.DataFrame({
+            field: self.column(field, self._expand(columns.get(field), length))
+            for field in self.fields})
+        if len(self.fields) != len(self.columns):
+            data = data[self.columns]
+        return data
+
+    @staticmethod
+    def _expand(values, length):
+        import pandas as pd
+        if pd.api.types.is_list_like(values):
+            return values
+        return [values] * length
+
+    def from_rows(self, rows):
+        ''' Build a dataframe of the file from rows.
+
+        rows : list of tuples in the order of columns
+
+        returns : dataframe with the columns of the file, in order
+        '''
+        return self.frame(dict(zip(self.columns, map(list, zip(*rows)))))
+
+    def typed(self, data):
+        ''' Return a copy of a dataframe, for example one read as strings,
+        with the column types of the file. Repeated columns are kept only
+        once.
+
+        data : dataframe with columns of the file
+        '''
+        import pandas as pd
+
+        data = data.loc[:, ~data.columns.duplicated()]
+        return pd.DataFrame({column: self.column(column, data[column])
+                             for column in data.columns}, index=data.index)
+
+
+class ColumnBuffer:
+    ''' Rows of a data file, held as one list per column.
+
+    schema : the Schema of the file
+    '''
+
+    __slots__ = ('schema', 'columns')
+
+    def __init__(self, schema):
+        self.schema = schema
+        self.columns = {field: [] for field in schema.fields}
+
+    def __len__(self):
+        return len(self.columns['subject_id'])
+
+    def add(self, source, **values):
+        ''' Add a row from a dictionary, for example a summary returned by
+        the API. Keys that are not columns are ignored, columns that are not
+        keys are missing.
+
+        source : dictionary of the values
+        values : values replacing or adding to those in source
+        '''
+        for field, column in self.columns.items():
+            column.append(values[field] if field in values else source.get(field))
+
+    def append(self, record):
+        ''' Add a row as a tuple in the order of the fields, see Schema.record '''
+        for column, value in zip(self.columns.values(), record):
+            column.append(value)
+
+    def column(self, field):
+        ''' The values of a column added so far '''
+        return self.columns[field]
+
+    def frame(self):
+        ''' The rows as a dataframe with typed columns '''
+        return self.schema.frame(self.columns)
+
+
+schemas = {stream: Schema(stream, columns) for stream, columns in file_columns.items()}
+
+
+def of(name):
+    ''' The schema of a data file
+
+    name : the name of the data file, for example 'activity_steps', or its
+           file name with folder and extension
+    '''
+    return schemas[os.path.basename(name).split('.')[0]]
@@ -1,7 +1,94 @@
 # Settings
 # ========
 
-raw_data_folder = "../raw_data/"
+import os
+
+# Folder of the data files. Can be set with the RAW_DATA_FOLDER environment
+# variable.
+raw_data_folder = os.environ.get('RAW_DATA_FOLDER', "../raw_data/")
+
+# Rows are buffered and appended to the data files when this many rows are
+# buffered, or when this many seconds have passed since the last write
+writer_batch_rows = 200000
+writer_flush_seconds = 60
+
+# Output format of the data files: 'csv', 'parquet' or 'both'. Parquet files
+# are written under parquet_folder, in one directory per data file and date
+# (and per subject if parquet_partition_by_subject is set). Parquet output
+# requires pyarrow.
+output_format = 'csv'
+parquet_folder = raw_data_folder + "parquet/"
+parquet_partition_by_subject = False
+
+# The sample files can be written compressed, with compression set to 'gzip'
+# or 'zstd' (requires zstandard). Each write is appended as its own gzip
+# member or zstd frame, so the files stay append-only. The compressed files
+# are named like exercise_samples.csv.gz, see compressed.py for reading them.
+# When compression is switched on, existing plain files of these streams are
+# compressed into the new files before rows are first written to them, and
+# removed. To migrate right away, run python3 compressed.py with no pull
+# running.
+# Switch it between runs, not while a run or a merge is in progress.
+compression = None
+compressed_streams = ['exercise_samples', 'sleep_samples', 'activity_steps']
+
+# The exercise and sleep samples can be resampled to windows of
+# resample_seconds as they are written, see resample.py. With resample_mode
+# 'off' only the samples as recorded are written, with 'alongside' also the
+# resampled samples, to exercise_samples_resampled.csv and
+# sleep_samples_resampled.csv, and with 'instead' only the resampled ones.
+# The samples of a window are combined by the function set for their sample
+# type in resample_functions, or by the mean. The distance samples of
+# exercises are cumulative, so the last one of a window is kept. Sample types
+# set to None are not resampled.
+resample_mode = 'off'
+resample_seconds = 60
+resample_functions = {'Distance (m)': 'last', 'RR Interval (ms)': None, 'hypnogram': None}
+
+# SQLite database with the latest date written for each subject and data file
+state_file = raw_data_folder + "state.sqlite"
+
+# SQLite database of the daily rollups (steps per day, minutes in each heart
+# rate zone per day and heart rate statistics of each exercise), updated from
+# the rows written in each run. Set to None to not maintain the rollups.
+rollup_file = raw_data_folder + "rollups.sqlite"
+
+# Memory used by compact.py for each part of a file, in bytes. Larger files
+# are split into parts of about this size, and a part whose keys take more
+# memory than this is deduplicated in several passes.
+compaction_memory = 512*1024*1024
+
+# Journal of the current run, used to continue a run that was interrupted
+journal_file = raw_data_folder + "run_journal"
+
+# Responses that do not change (activity and exercise summaries and their
+# samples) are cached in cache_folder until the transaction they belong to is
+# committed, so a transaction that failed is not downloaded again in full.
+# The least recently used responses are removed when the cache is larger
+# than cache_size bytes. Set cache_size to 0 to disable the cache.
+cache_folder = raw_data_folder + "cache/"
+cache_size = 1024*1024*1024
+
+# Metrics of each run (request latencies, retries, rows written, time per
+# subject and stage) are appended to metrics_file as JSON lines. Set
+# prometheus_file to also write them in the Prometheus text format, for
+# example into the directory of the node_exporter textfile collector.
+metrics_file = raw_data_folder + "metrics.jsonl"
+prometheus_file = None
+
+# Number of subjects pulled concurrently by acceslink.py. Set to 1 to pull
+# one subject at a time.
+max_subjects_in_flight = 8
+
+# Number of concurrent requests made for a single subject, for example when
+# fetching the summaries and samples of an activity transaction.
+max_requests_in_flight = 4
+
+# Number of concurrent API calls when registering or deleting users
+max_registrations_in_flight = 16
+
+# Number of nights fetched concurrently by backfill.py, over all subjects
+max_backfill_in_flight = 16
 
 # Set columns to keep from activity data, exercise data and
 # sleep data
@@ -10,11 +97,124 @@ exercise_columns = ["subject_id", "start-time", "calories", "distance", "duratio
 sleep_columns = ["subject_id", "date", "sleep_start_time", "sleep_end_time", "continuity", "light_sleep", "deep_sleep", "rem_sleep", "unrecognized_sleep_stage", 'total_interruption_duration']
 recharge_columns = ["subject_id", 'date', 'heart_rate_avg', 'beat_to_beat_avg', 'heart_rate_variability_avg', 'breathing_rate_avg', 'nightly_recharge_status', 'ans_charge', 'ans_charge_status']
 
+# Columns of the sample files. The "index" column of the zone file is kept
+# empty for compatibility with existing files, the zone is in "zone index".
+step_columns = ["subject_id", "date", "time", "steps"]
+zone_columns = ["subject_id", "date", "time", "index", "duration", "zone index", "zone name"]
+exercise_sample_columns = ['subject_id', 'exercise-start-time', 'sample-index', 'recording-rate', 'sample-type', 'sample-name', 'sample']
+sleep_sample_columns = ['subject_id', 'date', 'sample-time', 'sample-type', 'sample']
+resampled_exercise_sample_columns = exercise_sample_columns + ['sample-min', 'sample-max', 'sample-count']
+resampled_sleep_sample_columns = sleep_sample_columns + ['sample-min', 'sample-max', 'sample-count']
+
+# Columns of each data file, by file name. The files also have an unnamed
+# row index as their first column.
+file_columns = {
+    'activity_summary': activity_columns,
+    'activity_steps': step_columns,
+    'activity_zones': zone_columns,
+    'exercise_summary': exercise_columns,
+    'exercise_samples': exercise_sample_columns,
+    'sleep_summary': sleep_columns,
+    'sleep_samples': sleep_sample_columns,
+    'nightly_recharge_summary': recharge_columns,
+    'exercise_samples_resampled': resampled_exercise_sample_columns,
+    'sleep_samples_resampled': resampled_sleep_sample_columns,
+}
+
+# Columns identifying a row of each data file. Rows with the same values
+# are the same data, fetched more than once.
+natural_keys = {
+    'activity_summary': ['subject_id', 'date'],
+    'activity_steps': ['subject_id', 'date', 'time'],
+    'activity_zones': ['subject_id', 'date', 'time', 'zone index'],
+    'exercise_summary': ['subject_id', 'start-time'],
+    'exercise_samples': ['subject_id', 'exercise-start-time', 'sample-type', 'sample-index'],
+    'sleep_summary': ['subject_id', 'date'],
+    'sleep_samples': ['subject_id', 'date', 'sample-type', 'sample-time'],
+    'nightly_recharge_summary': ['subject_id', 'date'],
+    'exercise_samples_resampled': ['subject_id', 'exercise-start-time', 'sample-type', 'recording-rate', 'sample-index'],
+    'sleep_samples_resampled': ['subject_id', 'date', 'sample-type', 'sample-time'],
+}
+
+# The date (or start time) column of each data file, by file name
+date_columns = {
+    'activity_summary': 'date',
+    'activity_steps': 'date',
+    'activity_zones': 'date',
+    'exercise_summary': 'start-time',
+    'exercise_samples': 'exercise-start-time',
+    'sleep_summary': 'date',
+    'sleep_samples': 'date',
+    'nightly_recharge_summary': 'date',
+    'exercise_samples_resampled': 'exercise-start-time',
+    'sleep_samples_resampled': 'date',
+}
+
+# Types of the columns in typed outputs. Columns not listed are strings.
+column_types = {
+    'subject_id': 'Int64',
+    'calories': 'Float64',
+    'active-calories': 'Float64',
+    'duration': 'Float64',
+    'active-steps': 'Int64',
+    'distance': 'Float64',
+    'training-load': 'Float64',
+    'max-heart-rate': 'Float64',
+    'average-heart-rate': 'Float64',
+    'fat-percentage': 'Float64',
+    'carbohydrate-percentage': 'Float64',
+    'protein-percentage': 'Float64',
+    'continuity': 'Float64',
+    'light_sleep': 'Float64',
+    'deep_sleep': 'Float64',
+    'rem_sleep': 'Float64',
+    'unrecognized_sleep_stage': 'Float64',
+    'total_interruption_duration': 'Float64',
+    'heart_rate_avg': 'Float64',
+    'beat_to_beat_avg': 'Float64',
+    'heart_rate_variability_avg': 'Float64',
+    'breathing_rate_avg': 'Float64',
+    'nightly_recharge_status': 'Float64',
+    'ans_charge': 'Float64',
+    'ans_charge_status': 'Float64',
+    'steps': 'Int64',
+    'zone index': 'Int64',
+    'sample-index': 'Int64',
+    'recording-rate': 'Int64',
+    'sample-type': 'string',
+    'sample': 'Float64',
+    'sample-min': 'Float64',
+    'sample-max': 'Float64',
+    'sample-count': 'Int64',
+}
+
 # Descriptive names for heart rate zones
 zone_names = ['sleep', 'sedentary', 'light', 'moderate', 'vigorous', 'not worn']
 
 # Descriptive names for the sample indices
 sample_names = ['Heart rate (bpm)', 'Speed (km/h)', 'Cadence (rpm)', 'Altitude (m)', 'Power (W)', 'Power pedaling index (%)', 'Power left-right balance (%)', 'Air pressure (hpa)', 'Running cadence (spm)', 'Temperature (C)', 'Distance (m)', 'RR Interval (ms)']
 
-# URL to the Polar Acceslink API
-api_url = 'https://www.polaraccesslink.com/v3/users'
+# URL to the Polar Acceslink API. Can be set with the ACCESSLINK_API_URL
+# environment variable, for example to use mock_server.py.
+api_url = os.environ.get('ACCESSLINK_API_URL', 'https://www.polaraccesslink.com/v3/users')
+
+# HTTP client settings. The pool size is the number of connections kept open
+# to the API and should be at least max_subjects_in_flight. The timeout is
+# (connect, read) in seconds.
+http_pool_size = 32
+http_timeout = (10, 60)
+http_compression = True
+
+# Rate limits of the API. The number of requests allowed in each window is
+# base + per_user * (number of registered users). Responses with status 429
+# or 503 are retried up to http_retries times after the time given by the
+# API, or retry_backoff seconds if the API does not say.
+rate_limit_short = {'base': 500, 'per_user': 20, 'window': 15*60}
+rate_limit_long = {'base': 5000, 'per_user': 100, 'window': 24*60*60}
+http_retries = 10
+retry_backoff = 20
+
+# Number of attempts made by utils.retry_and_report for other errors, with an
+# exponentially growing delay starting from retry_delay seconds.
+retry_attempts = 5
+retry_delay = 2
@@ -0,0 +1,183 @@
+# Sharded runs. The users in the tokens file can be split into N shards by
+# a stable hash of their pseudonym, and each shard pulled by its own process,
+# on the same or different hosts:
+#
+#   python3 acceslink.py --shards 4 --shard 0
+#   ...
+#   python3 acceslink.py --shards 4 --shard 3
+#
+# A shard writes its csv files, run journal and metrics to its own folder,
+# raw_data_folder/shards/<k>-of-<N>/. The state store, the response cache and
+# the Parquet files are shared. Each shard uses 1/N of the rate limits of the
+# API, so together they stay within them. Hosts must share the data folder.
+#
+# When all shards have finished, merge their csv files into the data files
+# in the raw data folder, in shard order:
+#
+#   python3 sharding.py 4
+#
+# Do not run the merge while shards are running.
+
+import os
+import sys
+import zlib
+
+import compressed
+import journal
+import state
+import utils
+import writer
+from settings import raw_data_folder, file_columns
+
+
+def shard_of(subject_id, shards):
+    ''' The shard of a subject. The same pseudonym is always in the same
+    shard, on every host and in every run.
+
+    subject_id : the pseudonym of the subject
+    shards : number of shards
+    '''
+    return zlib.crc32(str(int(subject_id)).encode()) % shards
+
+
+def shard_folder(shard, shards):
+    ''' The folder of the csv files, journal and metrics of a shard '''
+    return raw_data_folder + f"shards/{shard}-of-{shards}/"
+
+
+def configure(shard, shards):
+    ''' Write the csv files and the journal of this process to the folder of
+    a shard. Call this before pulling any data.
+
+    shard : the shard of this process, from 0 to shards-1
+    shards : number of shards
+
+    returns : the folder of the shard
+    '''
+    if not 0 <= shard < shards:
+        raise ValueError(f"Shard {shard} is not between 0 and {shards - 1}")
+
+    folder = shard_folder(shard, shards)
+    os.makedirs(folder, exist_ok=True)
+    writer.redirect(folder)
+    journal.use(folder + "run_journal")
+    return folder
+
+
+def complete_end(data_file, block_size=65536):
+    ''' The position after the last complete line of a file '''
+    end = data_file.seek(0, os.SEEK_END)
+    while end > 0:
+        start = max(0, end - block_size)
+        data_file.seek(start)
+        newline = data_file.read(end - start).rfind(b'\n')
+        if newline >= 0:
+            return start + newline + 1
+        end = start
+    return 0
+
+
+def merge_file(shard_filename, filename, block_size=1024*1024):
+    ''' Append the rows of a shard's csv file to a data file and remove the
+    shard's file. The number of bytes merged is kept in the state store, so
+    an interrupted merge continues where it stopped.
+
+    shard_filename : the csv file of the shard
+    filename : the data file
+
+    returns : number of bytes merged
+    '''
+    state_store = state.store()
+    offset = state_store.get_offset(shard_filename)
+
+    with open(shard_filename, 'rb') as shard_file:
+        header = shard_file.readline()
+        if not header.startswith(b',subject_id'):
+            header = b''
+        offset = max(offset, len(header))
+        end = complete_end(shard_file)
+
+        with utils.write_lock:
+            with open(filename, 'ab+') as data_file:
+                utils.remove_partial_line(data_file)
+                if data_file.seek(0, os.SEEK_END) == 0:
+                    data_file.write(header)
+                shard_file.seek(offset)
+                while shard_file.tell() < end:
+                    data_file.write(shard_file.read(min(block_size, end - shard_file.tell())))
+                data_file.flush()
+                os.fsync(data_file.fileno())
+        state_store.set_offset(shard_filename, end)
+
+    # If the merge stops between these two, the file is merged again and
+    # its rows are duplicated, which compact.py removes. The other order
+    # could skip rows.
+    state_store.reset_offset(shard_filename)
+    os.remove(shard_filename)
+    return end - offset
+
+
+def merge_compressed(shard_filename, filename):
+    ''' Append the frames of a shard's compressed file to a compressed data
+    file and remove the shard's file. The header row is only kept if the data
+    file is new. Progress is kept in the state store after every frame.
+
+    shard_filename : the compressed file of the shard
+    filename : the compressed data file
+
+    returns : number of uncompressed bytes merged
+    '''
+    state_store = state.store()
+    offset = state_store.get_offset(shard_filename)
+
+    merged = 0
+    for end, payload in compressed.frames(shard_filename, offset):
+        header = b''
+        if payload.startswith(b',subject_id'):
+            newline = payload.find(b'\n') + 1
+            header, payload = payload[:newline], payload[newline:]
+
+        with utils.write_lock:
+            compressed.append_frame(filename, lambda empty: header + payload if empty else payload)
+        state_store.set_offset(shard_filename, end)
+        merged += len(payload)
+
+    # As in merge_file, rows may be duplicated but never skipped
+    state_store.reset_offset(shard_filename)
+    compressed.forget(shard_filename)
+    os.remove(shard_filename)
+    return merged
+
+
+def merge(shards):
+    ''' Merge the csv files of all shards into the data files, in shard
+    order and in the order of settings.file_columns.
+
+    shards : number of shards
+
+    returns : number of bytes merged
+    '''
+    merged = 0
+    for shard in range(shards):
+        folder = shard_folder(shard, shards)
+        for stream in file_columns:
+            shard_filename = compressed.path(folder + stream + ".csv")
+            filename = compressed.path(raw_data_folder + stream + ".csv")
+            if not os.path.exists(shard_filename):
+                continue
+            if compressed.codec_of(filename) is None:
+                merged += merge_file(shard_filename, filename)
+            else:
+                with utils.write_lock:
+                    compressed.migrate_once(raw_data_folder + stream + ".csv", filename)
+                merged += merge_compressed(shard_filename, filename)
+    return merged
+
+
+# If run as a script, merge the shards
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print("Usage: python3 sharding.py SHARDS")
+        sys.exit(1)
+    merged = merge(int(sys.argv[1]))
+    print(f"Merged {merged} bytes")
@@ -0,0 +1,178 @@
+''' Persistent per-subject state of the data files.
+
+Keeps the latest date written for each subject and data stream in a small
+SQLite database, so finding where a subject's data ends does not require
+reading the whole csv file. The first time a stream is used, its watermarks
+are seeded from the existing csv file in a single pass.
+
+Watermarks are updated after the corresponding rows are appended to the csv
+file. If the process stops in between, the watermark is behind the file and
+the same rows may be written again, but no data is skipped.
+'''
+
+import os
+import sqlite3
+import threading
+
+from settings import state_file
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+class StateStore:
+    ''' Latest date or timestamp per subject and stream.
+
+    filename : the SQLite database file
+    '''
+
+    def __init__(self, filename):
+        self.lock = threading.RLock()
+        self.connection = sqlite3.connect(filename, timeout=60, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS watermarks ('
+                'subject_id INTEGER, stream TEXT, value TEXT, '
+                'PRIMARY KEY (subject_id, stream))')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS seeded (stream TEXT PRIMARY KEY)')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS offsets (filename TEXT PRIMARY KEY, offset INTEGER)')
+
+    def get(self, subject_id, stream):
+        ''' Return the watermark of a subject, or None if there is none '''
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT value FROM watermarks WHERE subject_id = ? AND stream = ?',
+                (subject_id, stream)).fetchone()
+        return None if row is None else row[0]
+
+    def update(self, values, stream):
+        ''' Move watermarks forward. A watermark is never moved back.
+
+        values : dictionary from subject ID to the new value
+        stream : name of the data stream
+        '''
+        with self.lock, self.connection:
+            self._update(values, stream)
+
+    def _update(self, values, stream):
+        # Update without committing, so the change can be part of a larger
+        # transaction
+        self.connection.executemany(
+            'INSERT INTO watermarks (subject_id, stream, value) VALUES (?, ?, ?) '
+            'ON CONFLICT (subject_id, stream) DO UPDATE SET value = max(value, excluded.value)',
+            [(int(subject_id), stream, str(value)) for subject_id, value in values.items()])
+
+    def all(self, stream):
+        ''' Return the watermarks of all subjects in a stream as a dictionary '''
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT subject_id, value FROM watermarks WHERE stream = ?',
+                (stream,)).fetchall()
+        return dict(rows)
+
+    def get_offset(self, filename):
+        ''' Return the number of bytes of a file already scanned '''
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT offset FROM offsets WHERE filename = ?', (filename,)).fetchone()
+        return 0 if row is None else row[0]
+
+    def update_scan(self, filename, offset, values, stream):
+        ''' Store the watermarks found by scanning a file together with
+        the offset the scan reached, in a single transaction.
+
+        filename : the scanned file
+        offset : number of bytes scanned
+        values : dictionary from subject ID to the latest value found
+        stream : name of the data stream
+        '''
+        with self.lock, self.connection:
+            self._update(values, stream)
+            self.connection.execute(
+                'INSERT INTO offsets (filename, offset) VALUES (?, ?) '
+                'ON CONFLICT (filename) DO UPDATE SET offset = excluded.offset',
+                (filename, offset))
+
+    def set_offset(self, filename, offset):
+        ''' Store the number of bytes of a file already processed '''
+        with self.lock, self.connection:
+            self.connection.execute(
+                'INSERT INTO offsets (filename, offset) VALUES (?, ?) '
+                'ON CONFLICT (filename) DO UPDATE SET offset = excluded.offset',
+                (filename, offset))
+
+    def reset_offset(self, filename):
+        ''' Scan a file from the start next time, for example after it has
+        been rewritten
+        '''
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM offsets WHERE filename = ?', (filename,))
+
+    def is_seeded(self, stream):
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT 1 FROM seeded WHERE stream = ?', (stream,)).fetchone()
+        return row is not None
+
+    def seed(self, stream, filename, column='date'):
+        ''' Initialize the watermarks of a stream from an existing csv file.
+        The file is read in chunks, so it does not need to fit in memory.
+
+        stream : name of the data stream
+        filename : csv file with a header row
+        column : the column containing the date or timestamp
+        '''
+        import compressed
+
+        with self.lock:
+            if self.is_seeded(stream):
+                return
+
+            latest = {}
+            if os.path.exists(compressed.existing(filename)):
+                chunks = compressed.read_csv(filename, usecols=['subject_id', column],
+                                             dtype=str, chunksize=1000000)
+                for chunk in chunks:
+                    chunk = chunk.dropna()
+                    for subject_id, value in chunk.groupby('subject_id')[column].max().items():
+                        subject_id = int(float(subject_id))
+                        if subject_id not in latest or value > latest[subject_id]:
+                            latest[subject_id] = value
+
+            with self.connection:
+                self._update(latest, stream)
+                self.connection.execute('INSERT INTO seeded (stream) VALUES (?)', (stream,))
+
+
+def store():
+    ''' Return the shared state store, opening it on first use '''
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = StateStore(state_file)
+    return _store
+
+
+def latest(subject_id, stream, filename, column='date'):
+    ''' Return the latest value written for a subject in a stream, seeding
+    the stream from filename if needed.
+
+    subject_id : the pseudonymous subject ID
+    stream : name of the data stream
+    filename : the csv file of the stream
+    column : the column containing the date or timestamp
+
+    returns : the latest value as a string, or None if the subject has no data
+    '''
+    state_store = store()
+    if not state_store.is_seeded(stream):
+        state_store.seed(stream, filename, column)
+    return state_store.get(subject_id, stream)
+
+
+def update(subject_id, stream, value):
+    ''' Move the watermark of a subject forward '''
+    store().update({subject_id: value}, stream)
@@ -0,0 +1,55 @@
+''' Checks of the duration parsing in utils.py. Run with python3 -m pytest '''
+
+import math
+
+import pytest
+
+import utils
+
+
+valid = {
+    'PT1H2M3S': 3723,
+    'PT3S': 3,
+    'PT0S': 0,
+    'PT45M': 2700,
+    'PT1.5S': 1.5,
+    'PT1,5S': 1.5,
+    'PT2H0.25S': 7200.25,
+    'P1DT2H': 93600,
+    'P1D': 86400,
+    'P1W': 604800,
+    '-PT5S': -5,
+    '+PT5S': 5,
+    '': 0,
+    None: 0,
+}
+
+invalid = ['P', 'PT', 'P1DT', 'T1H', '1H', 'PT1X', 'PT-1S', 'bad']
+
+
+@pytest.mark.parametrize('duration, seconds', valid.items())
+def test_extract_time(duration, seconds):
+    assert utils.extract_time(duration) == seconds
+
+
+def test_extract_time_integer():
+    assert isinstance(utils.extract_time('PT1H2M3S'), int)
+    assert isinstance(utils.extract_time('PT1.5S'), float)
+
+
+@pytest.mark.parametrize('duration', invalid)
+def test_extract_time_invalid(duration):
+    with pytest.raises(ValueError):
+        utils.extract_time(duration)
+
+
+def test_extract_times_agrees():
+    durations = list(valid)
+    seconds = utils.extract_times(durations)
+    assert seconds.tolist() == [utils.extract_time(duration) for duration in durations]
+
+
+def test_extract_times_invalid():
+    seconds = utils.extract_times(invalid + ['PT3S'])
+    assert all(math.isnan(value) for value in seconds[:-1])
+    assert seconds.iloc[-1] == 3
@@ -0,0 +1,167 @@
+''' The registry of user tokens.
+
+The tokens file has one registered user per line:
+
+  token polar_user_id pseudonym
+
+TokenRegistry reads the file and indexes the users by token, Polar user ID
+and pseudonym. A pseudonym can have more than one line, for example after
+the subject authorized again with a new token. Registering and deleting users is done in batches: the API
+calls are made concurrently and the file is rewritten once per batch,
+atomically.
+'''
+
+import os
+
+import utils
+from settings import max_registrations_in_flight
+
+
+def parse_line(line):
+    ''' Split a line of a tokens file
+
+    line : "token polar_user_id pseudonym"
+
+    returns : tuple (token, polar_user_id, pseudonym), with the pseudonym as
+              an integer
+    '''
+    token, user, subject_id = line.split()
+    return token, user, int(subject_id)
+
+
+def read_entries(filename):
+    ''' Read the entries of a tokens file, skipping empty lines. A missing
+    file has no entries.
+    '''
+    if not os.path.exists(filename):
+        return []
+    with open(filename, 'r') as token_file:
+        return [parse_line(line) for line in token_file if line.strip()]
+
+
+def read_ids(filename):
+    ''' Read a file of pseudonyms, one per line, skipping empty lines. A
+    missing file has no pseudonyms.
+    '''
+    if not os.path.exists(filename):
+        return []
+    with open(filename, 'r') as id_file:
+        return [int(line) for line in id_file if line.strip()]
+
+
+def succeeded(function, *args):
+    ''' Call an API function, counting errors as a failure '''
+    try:
+        return function(*args)
+    except Exception as e:
+        print("Encountered error:", e)
+        return False
+
+
+class TokenRegistry:
+    ''' Registered users, read from a tokens file.
+
+    filename : the tokens file
+    '''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.by_token = {}
+        self.by_user = {}
+        self.by_subject = {}
+        for entry in read_entries(filename):
+            self.add(entry)
+
+    def __len__(self):
+        return len(self.by_token)
+
+    def __iter__(self):
+        return iter(self.by_token.values())
+
+    def add(self, entry):
+        ''' Add an entry (token, polar_user_id, pseudonym) '''
+        token, user, subject_id = entry
+        if token in self.by_token:
+            self.remove(self.by_token[token])
+        self.by_token[token] = entry
+        self.by_user[user] = entry
+        self.by_subject.setdefault(subject_id, []).append(entry)
+
+    def remove(self, entry):
+        ''' Remove an entry (token, polar_user_id, pseudonym) '''
+        token, user, subject_id = entry
+        self.by_token.pop(token, None)
+        if self.by_user.get(user) == entry:
+            del self.by_user[user]
+        entries = [e for e in self.by_subject.get(subject_id, []) if e != entry]
+        if entries:
+            self.by_subject[subject_id] = entries
+        else:
+            self.by_subject.pop(subject_id, None)
+
+    def save(self):
+        ''' Write the registry to its file. The new file replaces the old one
+        only once it is completely written.
+        '''
+        temp_filename = self.filename + '.tmp'
+        with open(temp_filename, 'w') as token_file:
+            for token, user, subject_id in self:
+                token_file.write(f"{token} {user} {subject_id}\n")
+            token_file.flush()
+            os.fsync(token_file.fileno())
+        os.replace(temp_filename, self.filename)
+
+    def register(self, entries, register_function):
+        ''' Register new users concurrently and add the successful ones.
+        Entries whose token is already registered are skipped. The file is
+        not written, call save after the batch.
+
+        entries : list of (token, polar_user_id, pseudonym)
+        register_function : function taking a token, returns True on success
+
+        returns : list of the entries that failed
+        '''
+        new_entries = {}
+        for entry in entries:
+            if entry[0] not in self.by_token:
+                new_entries[entry[0]] = entry
+        new_entries = list(new_entries.values())
+
+        results = utils.map_concurrent(
+            lambda entry: succeeded(register_function, entry[0]), new_entries,
+            max_registrations_in_flight)
+
+        failed = []
+        for entry, success in zip(new_entries, results):
+            if success:
+                self.add(entry)
+            else:
+                failed.append(entry)
+        return failed
+
+    def delete(self, subject_ids, delete_function):
+        ''' Delete users concurrently by pseudonym and remove them. Every
+        entry of a pseudonym is deleted and removed. Users are removed from
+        the registry even if the API call fails, so their data is no longer
+        accessed. The file is not written, call save after the batch.
+
+        subject_ids : list of pseudonyms
+        delete_function : function taking a token and a Polar user ID,
+                          returns True on success
+
+        returns : list of the entries for which the API call failed
+        '''
+        entries = list({entry[0]: entry
+                        for subject_id in subject_ids
+                        for entry in self.by_subject.get(subject_id, [])}.values())
+
+        results = utils.map_concurrent(
+            lambda entry: succeeded(delete_function, entry[0], entry[1]), entries,
+            max_registrations_in_flight)
+
+        failed = []
+        for entry, success in zip(entries, results):
+            self.remove(entry)
+            if not success:
+                failed.append(entry)
+        return failed
@@ -1,74 +1,194 @@
+import functools
+import os
+import re
 import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
+import requests
 
+import metrics
+from settings import max_requests_in_flight, retry_attempts, retry_delay
+
+
+# Serializes appends to the shared csv files when subjects are pulled
+# concurrently
+write_lock = threading.Lock()
+
+
+# ISO 8601 duration, for example "PT1H2M3.5S" or "P1DT2H". Each part is a
+# number with an optional fraction, the sign is optional.
+_number = r'(\d+(?:[.,]\d+)?)'
+duration_pattern = (f'^([-+])?P(?:{_number}Y)?(?:{_number}M)?(?:{_number}W)?(?:{_number}D)?'
+                    f'(?:T(?:{_number}H)?(?:{_number}M)?(?:{_number}S)?)?$')
+_duration_regex = re.compile(duration_pattern)
+
+# Seconds in each part of the duration, in the order of the pattern. Years
+# and months do not have a fixed length, they are counted as 365 and 30 days.
+_duration_units = [365*86400, 30*86400, 7*86400, 86400, 3600, 60, 1]
+
+
+@functools.lru_cache(maxsize=4096)
 def extract_time(time_string):
     ''' Utility for extracting hours, minutes and seconds
-    from the API time format
+    from the API time format (ISO 8601 durations, for example PT1H2M3.5S)
 
     time_string : time value returened by the Acceslink API
 
-    return : time in seconds
+    return : time in seconds. An integer if the duration is a whole number
+             of seconds. An empty string or None (missing value) returns 0.
+             An invalid duration raises ValueError, where extract_times
+             gives NaN.
     '''
+    if time_string is None or time_string == '':
+        return 0
 
-    t = ''
+    match = _duration_regex.match(time_string)
+    if match is None or time_string.endswith(('P', 'T')):
+        raise ValueError(f"Invalid duration: {time_string}")
+
+    sign, *parts = match.groups()
     seconds = 0
-    for c in time_string:
-        if c == 'P':
-            # The string starts with PT, which we skip
-            pass
-        elif c == 'T':
-            # The string starts with PT, which we skip
-            pass
-        elif c == 'H':
-            # Hours
-            seconds += 3600*int(t)
-            t = ''
-        elif c == 'M':
-            # Minutes
-            seconds = 60*int(t)
-            t = ''
-        elif c == 'S':
-            # Seconds
-            seconds = float(t)
-            t = ''
-        else:
-            t += c
+    for part, unit in zip(parts, _duration_units):
+        if part is not None:
+            seconds += float(part.replace(',', '.')) * unit
 
+    if sign == '-':
+        seconds = -seconds
+    if float(seconds).is_integer():
+        return int(seconds)
     return seconds
 
 
-def prune_data(data, columns):
-    ''' Clean data by extracting given set of columns and
-    adding an empty for missing data.
+def extract_times(time_strings):
+    ''' Vectorized extract_time for a column of durations.
+
+    time_strings : list, array or series of duration strings
+
+    return : float series of times in seconds. Missing and empty values
+             are 0, as in extract_time. Invalid values, for which
+             extract_time raises ValueError, are NaN.
+    '''
+    import pandas as pd
+
+    values = pd.Series(time_strings, dtype='string').fillna('')
+    parts = values.str.extract(duration_pattern)
+    valid = parts.iloc[:, 1:].notna().any(axis=1) & ~values.str.endswith('T')
+    valid = valid | (values == '')
+
+    seconds = 0
+    for column, unit in zip(parts.columns[1:], _duration_units):
+        part = pd.to_numeric(parts[column].str.replace(',', '.'), errors='coerce')
+        seconds = seconds + part.fillna(0).astype(float) * unit
+    seconds = seconds.where(parts[0].fillna('') != '-', -seconds)
+
+    return seconds.where(valid).astype(float)
+
+
+def append_csv(data, filename):
+    ''' Append a dataframe to a csv file. Holds the write lock, so that rows
+    written by different subjects are never interleaved. The rows are synced
+    to disk before returning. If an earlier write was interrupted and left an
+    incomplete last line, that line is removed first. The rows of an
+    interrupted write were never committed, so they are fetched again. A new
+    file starts with a header row.
 
-    data : the original data to prune
-    columns : list of keys to keep in the data
+    Streams set to be compressed are appended to the compressed file as a
+    new frame, see compressed.py.
 
-    returns : pruned data
+    data : the dataframe to write
+    filename : the csv file to append to
     '''
-    # Add empty strings for missing columns
-    for key in columns:
-        if key not in data:
-            data[key] = ''
+    import compressed
+    import schema
 
-    # Construct a dictionary of only the listed columns
-    return {key: data[key] for key in columns}
+    compressed_filename = compressed.path(filename)
+    if compressed_filename != filename:
+        with write_lock:
+            compressed.migrate_once(filename, compressed_filename)
+            compressed.append(compressed_filename, data)
+        return
+
+    with write_lock:
+        with open(filename, 'ab+') as data_file:
+            remove_partial_line(data_file)
+        new_file = os.path.getsize(filename) == 0
+        with open(filename, 'a', newline='') as data_file:
+            data.to_csv(data_file, header=new_file, float_format=schema.float_format)
+            data_file.flush()
+            os.fsync(data_file.fileno())
+
+
+def remove_partial_line(data_file, block_size=65536):
+    ''' Truncate a file opened in binary append mode after its last newline
+
+    data_file : file object opened with 'ab+'
+    '''
+    size = data_file.seek(0, os.SEEK_END)
+    if size == 0:
+        return
+    end = size
+    while end > 0:
+        start = max(0, end - block_size)
+        data_file.seek(start)
+        block = data_file.read(end - start)
+        if end == size and block.endswith(b'\n'):
+            return
+        newline = block.rfind(b'\n')
+        if newline >= 0:
+            data_file.truncate(start + newline + 1)
+            return
+        end = start
+
+    # No complete line at all. Rather than risk removing a header row,
+    # end the line so the new rows start on a line of their own.
+    data_file.write(b'\n')
+
+
+def map_concurrent(function, items, max_workers=max_requests_in_flight):
+    ''' Call function for each item, running up to max_workers calls at
+    the same time.
+
+    function : function taking a single item
+    items : the items to process
+    max_workers : maximum number of concurrent calls
+
+    returns : list of the return values, in the order of items. If any of
+              the calls fails, the first error is raised.
+    '''
+    items = list(items)
+    if max_workers <= 1 or len(items) <= 1:
+        return [function(item) for item in items]
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as executor:
+        return list(executor.map(function, items))
 
 
 def retry_and_report(try_function, *args):
-    ''' Try running an acceslink function. If it fails, report the error and retry after
-        20 seconds. Wait up to (about) 15 minutes, in case the problem is the rate limit.
+    ''' Try running an acceslink function. If it fails, report the error and retry
+        after an exponentially growing delay. Rate limits are handled by the
+        client, so errors here are not expected to last long. Client errors
+        (4xx), for example a revoked token, are not retried. Each retry is
+        recorded in metrics under the name of try_function.
+
+    returns : the return value of try_function, or None if all tries failed
     '''
     print(try_function.__name__)
-    for retry in range(50):
+    for retry in range(retry_attempts):
+        last = retry == retry_attempts - 1
         try:
-            try_function(*args)
+            return try_function(*args)
+        except requests.exceptions.HTTPError as e:
+            print("Encountered error:", e)
+            if e.response is not None and 400 <= e.response.status_code < 500:
+                return None
+            if not last:
+                status = e.response.status_code if e.response is not None else type(e).__name__
+                metrics.observe_retry(try_function.__name__, status)
         except Exception as e:
             print("Encountered error:", e)
-            # if failed, run the next iteration (retry)
-            time.sleep(20)
-            continue
-        # if succesfull, break from the loop
-        break
-
-
+            if not last:
+                metrics.observe_retry(try_function.__name__, type(e).__name__)
+        # if failed, run the next iteration (retry)
+        if not last:
+            time.sleep(retry_delay * 2**retry)
@@ -0,0 +1,225 @@
+''' Buffered writing of the csv data files.
+
+Rows written by the pull functions are collected in memory per output file,
+across subjects, and appended to the files in large chunks. A flush happens
+when writer_batch_rows rows are buffered, when writer_flush_seconds have
+passed since the last flush, or when the run ends. Each file is opened once
+per flush.
+
+The rows get the column types of their file (see schema.py), so every
+flush writes the same values the same way.
+
+Depending on settings.output_format, the rows are written as csv, as
+partitioned Parquet (see parquet_store) or both. The csv files can be
+redirected to another folder, for example the folder of a shard.
+
+Work that must only happen once the rows are on disk, such as moving a
+watermark in the state store, is passed as an after_flush callback and run
+right after the rows are written. If writing a file fails, the rows not
+yet written and the callbacks are put back in the buffer, and the callbacks
+wait for the next flush that succeeds.
+
+Work done with the rows themselves once they are written, such as
+updating the daily rollups, is registered as an on_write hook. Hooks are
+called with the file name and the rows of each file written.
+
+The number of rows and the time taken to write each file are recorded in
+metrics.
+'''
+
+import atexit
+import os
+import threading
+import time
+
+import metrics
+import schema
+import utils
+from settings import writer_batch_rows, writer_flush_seconds, output_format
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+class BatchWriter:
+    ''' Collects rows per output file and appends them in chunks.
+
+    batch_rows : flush when this many rows are buffered
+    flush_seconds : flush when this many seconds have passed since the
+                    last flush
+    folder : (Optional) write the csv files to this folder instead of the
+             one in their file name
+    '''
+
+    def __init__(self, batch_rows=writer_batch_rows, flush_seconds=writer_flush_seconds,
+                 folder=None):
+        self.batch_rows = batch_rows
+        self.flush_seconds = flush_seconds
+        self.folder = folder
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.buffers = {}
+        self.callbacks = []
+        self.hooks = []
+        self.rows = 0
+        self.last_flush = time.monotonic()
+
+    def write(self, filename, columns, rows, after_flush=None):
+        ''' Add rows to the buffer of a file.
+
+        filename : the csv file to append to
+        columns : the columns of the file, in order
+        rows : a schema.ColumnBuffer, a dataframe, or a list of tuples in
+               the order of columns
+        after_flush : (Optional) function called once the rows are written
+        '''
+        import pandas as pd
+
+        if isinstance(rows, schema.ColumnBuffer):
+            rows = rows.frame()
+        elif not isinstance(rows, pd.DataFrame):
+            rows = schema.of(filename).from_rows(rows)
+
+        with self.lock:
+            if filename not in self.buffers:
+                self.buffers[filename] = (columns, [])
+            self.buffers[filename][1].append(rows)
+            if after_flush is not None:
+                self.callbacks.append(after_flush)
+            self.rows += len(rows)
+
+            full = self.rows >= self.batch_rows
+            stale = time.monotonic() - self.last_flush >= self.flush_seconds
+
+        if full or stale:
+            try:
+                self.flush()
+            except Exception as e:
+                # The rows are kept and written by the next flush
+                print("Encountered error while writing:", e)
+
+    def after_flush(self, callback):
+        ''' Call a function once everything buffered so far is written
+
+        callback : function without arguments
+        '''
+        with self.lock:
+            self.callbacks.append(callback)
+
+    def on_write(self, hook):
+        ''' Call a function with the rows of every file written from now on
+
+        hook : function called with the file name and the dataframe of rows
+        '''
+        with self.lock:
+            if hook not in self.hooks:
+                self.hooks.append(hook)
+
+    def flush(self):
+        ''' Write all buffered rows and run the after_flush callbacks. If a
+        file cannot be written, the files not written and the callbacks are
+        returned to the buffer and the error is raised.
+        '''
+        import pandas as pd
+
+        # Flushes are done one at a time, so that the rows of each file are
+        # written in the order they were buffered
+        with self.flush_lock:
+            with self.lock:
+                buffers, self.buffers = self.buffers, {}
+                callbacks, self.callbacks = self.callbacks, []
+                hooks = list(self.hooks)
+                self.rows = 0
+                self.last_flush = time.monotonic()
+
+            written = set()
+            try:
+                for filename, (columns, parts) in buffers.items():
+                    data = pd.concat(parts, ignore_index=True)
+                    if len(data) > 0:
+                        self._write_file(filename, data, hooks)
+                    written.add(filename)
+            except Exception:
+                self._restore(buffers, written, callbacks)
+                raise
+
+            # A failing callback, for example a commit that could not be
+            # made, does not stop the others
+            for callback in callbacks:
+                try:
+                    callback()
+                except Exception as e:
+                    print("Encountered error after writing:", e)
+
+    def _write_file(self, filename, data, hooks):
+        # Write the rows of one file and call the on_write hooks
+        start = time.perf_counter()
+        if output_format in ('csv', 'both'):
+            csv_filename = filename
+            if self.folder is not None:
+                csv_filename = os.path.join(self.folder, os.path.basename(filename))
+            utils.append_csv(data, csv_filename)
+        if output_format in ('parquet', 'both'):
+            import parquet_store
+            parquet_store.write(filename, data)
+        metrics.observe_write(filename, len(data), time.perf_counter() - start)
+
+        for hook in hooks:
+            try:
+                hook(filename, data)
+            except Exception as e:
+                print(f"Encountered error after writing {filename}:", e)
+
+    def _restore(self, buffers, written, callbacks):
+        # Put the rows of the files not written back in front of the rows
+        # buffered since, and the callbacks back in front of the new ones
+        with self.lock:
+            restored = {}
+            for filename, (columns, parts) in buffers.items():
+                if filename not in written:
+                    restored[filename] = (columns, list(parts))
+                    self.rows += sum(len(part) for part in parts)
+            for filename, (columns, parts) in self.buffers.items():
+                restored.setdefault(filename, (columns, []))[1].extend(parts)
+            self.buffers = restored
+            self.callbacks = callbacks + self.callbacks
+
+
+def writer():
+    ''' Return the shared writer, creating it on first use. Anything left in
+    the buffers is written when the process exits.
+    '''
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = BatchWriter()
+            atexit.register(_writer.flush)
+    return _writer
+
+
+def write(filename, columns, rows, after_flush=None):
+    ''' Add rows to the shared writer, see BatchWriter.write '''
+    writer().write(filename, columns, rows, after_flush)
+
+
+def after_flush(callback):
+    ''' Add a callback to the shared writer, see BatchWriter.after_flush '''
+    writer().after_flush(callback)
+
+
+def on_write(hook):
+    ''' Add a hook to the shared writer, see BatchWriter.on_write '''
+    writer().on_write(hook)
+
+
+def flush():
+    ''' Flush the shared writer '''
+    writer().flush()
+
+
+def redirect(folder):
+    ''' Write the csv files of the shared writer to another folder. The
+    Parquet files are not affected, their names are unique.
+    '''
+    writer().folder = folder